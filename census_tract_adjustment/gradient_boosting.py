@@ -1,3 +1,9 @@
+import os
+import time
+import pickle
+import multiprocessing
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from io import BytesIO, StringIO
 import requests
 import numpy as np
@@ -5,22 +11,239 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 
-from sklearn.model_selection import train_test_split, KFold, GridSearchCV
+from sklearn.model_selection import train_test_split, KFold, GridSearchCV, GroupKFold, TimeSeriesSplit
 from sklearn.preprocessing import StandardScaler, MinMaxScaler
 from sklearn.metrics import r2_score, mean_absolute_error, mean_poisson_deviance
 from sklearn.ensemble import RandomForestRegressor
 from xgboost import XGBRegressor, plot_importance, DMatrix
-from lightgbm import LGBMRegressor, plot_importance
+from lightgbm import LGBMRegressor, plot_importance, Dataset
 from sklearn.tree import DecisionTreeClassifier
 
 # parameter tuning
 from itertools import product
 from collections import OrderedDict, defaultdict
 import hyperopt
-from hyperopt import fmin, tpe, hp, STATUS_OK, Trials
-from hyperopt.pyll import scope
+from hyperopt import fmin, tpe, hp, STATUS_OK, Trials, space_eval
+from hyperopt.base import Domain, JOB_STATE_DONE
+from hyperopt.pyll import scope, Apply
+from hyperopt.pyll.stochastic import sample
 
 from utils import *
+from model_registry import ModelRegistry
+
+# ------------------------------------------------------------------------------------
+
+# data of the tuning trials, set once per worker process by _init_tuning_worker
+_tuning_data = {}
+
+def _init_tuning_worker(X_train, y_train, X_test, y_test):
+	_tuning_data.update(X_train=X_train, y_train=y_train, X_test=X_test, y_test=y_test)
+
+def _run_tuning_trial(trial_fn, params, n_threads, **kwargs):
+	return trial_fn(params, n_threads=n_threads, **kwargs, **_tuning_data)
+
+def parallel_fmin(trial_fn, space, data, max_evals=50, n_jobs=None, trials_path=None, threads_per_trial=1, seed=None):
+	'''
+	TPE search like hyperopt's fmin, with the trials evaluated over a local process pool.
+	trial_fn(params, X_train, y_train, X_test, y_test, n_threads) is a module-level function returning
+	the hyperopt result dict, data the (X_train, y_train, X_test, y_test) tuple sent once to each worker.
+	Each trial is trained with threads_per_trial threads, so n_jobs * threads_per_trial should not exceed
+	the number of cores. With trials_path, the Trials are pickled there after every finished trial, and
+	an interrupted run resumes from the trials already done.
+	Returns the best point (as fmin does) and the Trials.
+	'''
+	trials = Trials()
+	if trials_path is not None and os.path.exists(trials_path):
+		with open(trials_path, 'rb') as f:
+			trials = pickle.load(f)
+
+	n_jobs = n_jobs or os.cpu_count()
+	domain = Domain(trial_fn, space)
+	rstate = np.random.default_rng(seed)
+	pending = {}
+	# spawn rather than fork: xgboost / lightgbm openmp threads are not fork-safe
+	with ProcessPoolExecutor(max_workers=n_jobs, mp_context=multiprocessing.get_context('spawn'),
+	                         initializer=_init_tuning_worker, initargs=data) as pool:
+		while len(trials.trials) < max_evals:
+			# keep every worker busy, proposing new points from the trials done so far
+			while len(pending) < n_jobs and len(trials.trials) + len(pending) < max_evals:
+				trials.refresh()
+				doc = tpe.suggest(trials.new_trial_ids(1), domain, trials, rstate.integers(2**31 - 1))[0]
+				params = space_eval(space, {label: vals[0] for label, vals in doc['misc']['vals'].items() if vals})
+				pending[pool.submit(_run_tuning_trial, trial_fn, params, threads_per_trial)] = doc
+
+			done, _ = wait(pending, return_when=FIRST_COMPLETED)
+			for future in done:
+				doc = pending.pop(future)
+				doc['state'] = JOB_STATE_DONE
+				doc['result'] = future.result()
+				trials.insert_trial_docs([doc])
+			trials.refresh()
+
+			if trials_path is not None:
+				with open(trials_path + '.tmp', 'wb') as f:
+					pickle.dump(trials, f)
+				os.replace(trials_path + '.tmp', trials_path)
+
+	return trials.argmin, trials
+
+def carve_validation_fold(X_train, y_train, ct_keys, random_state=100):
+	'''
+	Splits the training data into a fit and a validation fold the same way preprocess_train_test_data
+	splits the data into train and test (about one row per census tract held out, stratified by ct_key),
+	so that tuning never looks at the test set
+	'''
+	percent_unique = np.ceil(ct_keys.nunique()/len(ct_keys)*1000)/1000. #round up 3 d.p.
+	X_fit, X_val, y_fit, y_val = train_test_split(X_train, y_train, test_size=percent_unique, random_state=random_state, 
+		stratify=ct_keys)
+	return X_fit, y_fit, X_val, y_val
+
+def successive_halving(trial_fn, space, data, n_candidates=27, eta=3, max_trees=2000, early_stopping_rounds=20, n_jobs=1, 
+	threads_per_trial=None, seed=None):
+	'''
+	Budget-aware alternative to the TPE search: n_candidates points are sampled from space and trained on a
+	small number of trees; only the best 1/eta of them are promoted to the next rung, with eta times more trees,
+	up to max_trees for the last one. trial_fn and data are the same as for parallel_fmin, data holding the fit
+	and validation folds (see carve_validation_fold), and the rungs run over n_jobs processes.
+	Every rung trains at most about as many trees as a single full trial, i.e. log_eta(n_candidates) + 1
+	full trials in total.
+	Returns the best point in the format of fmin (the n_estimators being the early-stopped number of trees of the
+	last rung), and the rungs as (n_trees, candidates, results) tuples.
+	'''
+	rng = np.random.default_rng(seed)
+	labels = [label for label, value in space.items() if isinstance(value, Apply)]
+	candidates = [sample(space, rng=rng) for i in range(n_candidates)]
+
+	n_rungs = int(np.floor(np.log(n_candidates) / np.log(eta) + 1e-9)) + 1
+	rungs = []
+	pool = nullcontext() if n_jobs == 1 else ProcessPoolExecutor(max_workers=n_jobs, 
+		mp_context=multiprocessing.get_context('spawn'), initializer=_init_tuning_worker, initargs=data)
+	with pool:
+		for k in range(n_rungs):
+			n_trees = int(np.ceil(max_trees * eta**(k - n_rungs + 1)))
+			params = [dict(candidate, n_estimators=n_trees) for candidate in candidates]
+			if n_jobs == 1:
+				results = [trial_fn(p, *data, n_threads=threads_per_trial, early_stopping_rounds=early_stopping_rounds) 
+					for p in params]
+			else:
+				futures = [pool.submit(_run_tuning_trial, trial_fn, p, threads_per_trial, early_stopping_rounds=early_stopping_rounds) 
+					for p in params]
+				results = [future.result() for future in futures]
+			rungs.append((n_trees, candidates, results))
+
+			order = np.argsort([result['loss'] for result in results], kind='stable')
+			if k < n_rungs - 1:
+				candidates = [candidates[i] for i in order[:max(1, int(np.ceil(len(candidates) / eta)))]]
+
+	best = order[0]
+	hyperparameter = {label: candidates[best][label] for label in labels}
+	hyperparameter['n_estimators'] = results[best]['n_trees']
+	return hyperparameter, rungs
+
+class CompactTrainingData:
+	'''
+	Training data of the census tract models without the tract x month repetition of preprocess_data.
+	The features of the models are census tract features, constant over the months, so they are stored once per
+	census tract (normalized, float32); the monthly targets are stored per (tract, month) row of df_merged, and
+	ct_index maps each row to the features of its tract. Rows are positions in df_merged
+	'''
+	def __init__(self, df_merged, target_columns=['relative_listings_toBaseline', 'relative_sales_toBaseline'], scaler=None):
+		self.ct_keys, first_rows, ct_index = np.unique(df_merged['ct_key'].values, return_index=True, return_inverse=True)
+		self.ct_index = ct_index.astype(np.int32)
+		self.months = df_merged['month'].values
+
+		varying = df_merged.groupby('ct_key')[df_merged.columns.drop(NON_FEATURE_COLUMNS)].nunique(dropna=False).max()
+		if (varying > 1).any():
+			raise ValueError(f"features vary within a census tract: {list(varying[varying > 1].index)}")
+		features = get_feature_matrix(df_merged.iloc[first_rows])
+		self.feature_names = list(features.columns)
+
+		# min / max over the tracts are the same as over the repeated (tract, month) rows
+		self.scaler = scaler if scaler is not None else MinMaxScaler().fit(features)
+		self.features = self.scaler.transform(features).astype(np.float32)
+		self.targets = {col: df_merged[col].values.astype(np.float32) for col in target_columns}
+
+	def __len__(self):
+		return len(self.ct_index)
+
+	def nbytes(self):
+		return self.features.nbytes + self.ct_index.nbytes + sum(target.nbytes for target in self.targets.values())
+
+	def matrix(self, rows=None):
+		# float32 (rows x features) matrix, the same as the normalized features of preprocess_train_test_data
+		ct_index = self.ct_index if rows is None else self.ct_index[rows]
+		return self.features[ct_index]
+
+	def target(self, target_column, rows=None):
+		target = self.targets[target_column]
+		return target if rows is None else target[rows]
+
+	def dmatrix(self, target_column, rows=None, **kwargs):
+		return DMatrix(self.matrix(rows), label=self.target(target_column, rows), feature_names=self.feature_names, **kwargs)
+
+	def dataset(self, target_column, rows=None, **kwargs):
+		return Dataset(self.matrix(rows), label=self.target(target_column, rows), feature_name=self.feature_names, **kwargs)
+
+	def train_test_rows(self):
+		# the rows of the train / test split of preprocess_train_test_data
+		percent_unique = np.ceil(len(self.ct_keys)/len(self)*1000)/1000. #round up 3 d.p.
+		return train_test_split(np.arange(len(self)), test_size=percent_unique, random_state=100, stratify=self.ct_keys[self.ct_index])
+
+def get_cv_folds(df_merged, n_splits=5, by='ct_key'):
+	'''
+	Returns the (train rows, test rows) positions of the cross validation folds of df_merged:
+	by='ct_key' holds out whole census tracts (GroupKFold), by='month' is time-aware, training on the months
+	before each of n_splits consecutive blocks of months and testing on the block (TimeSeriesSplit over months)
+	'''
+	if by == 'ct_key':
+		return list(GroupKFold(n_splits=n_splits).split(df_merged, groups=df_merged['ct_key']))
+	months = np.sort(df_merged['month'].unique())
+	row_months = df_merged['month'].values
+	folds = []
+	for train_months, test_months in TimeSeriesSplit(n_splits=n_splits).split(months):
+		folds.append((np.flatnonzero(np.isin(row_months, months[train_months])), 
+			np.flatnonzero(np.isin(row_months, months[test_months]))))
+	return folds
+
+def _init_cv_worker(data, target_column):
+	_tuning_data.update(data=data, target_column=target_column)
+
+def _run_cv_fold(estimator_fn, hyperparameter, space, train_idx, test_idx, n_threads):
+	data, target_column = _tuning_data['data'], _tuning_data['target_column']
+	y_train, y_test = data.target(target_column, train_idx), data.target(target_column, test_idx)
+	start = time.perf_counter()
+	model = estimator_fn(hyperparameter, space, y_train, n_threads=n_threads)
+	model.fit(data.matrix(train_idx), y_train)
+	fit_seconds = time.perf_counter() - start
+	pred = model.predict(data.matrix(test_idx))
+	return {'mae': mean_absolute_error(y_test, pred), 'n_train': len(train_idx), 'n_test': len(test_idx), 
+		'fit_seconds': fit_seconds, 'predict_seconds': time.perf_counter() - start - fit_seconds}
+
+def cross_validate(estimator_fn, hyperparameter, space, df_merged, target_column, n_splits=5, by='ct_key', n_jobs=None, 
+	threads_per_fold=1):
+	'''
+	Cross validates estimator_fn (XGB_estimator or LGBM_estimator) with the given hyperparameter over the folds of
+	get_cv_folds. The features are normalized once (CompactTrainingData) and sent once to each worker process,
+	the folds are fitted over n_jobs processes with threads_per_fold threads each (n_jobs=1: in this process).
+	Returns a table with the MAE, sizes and timing of each fold
+	'''
+	data = CompactTrainingData(df_merged, target_columns=[target_column])
+	folds = get_cv_folds(df_merged, n_splits=n_splits, by=by)
+
+	if n_jobs == 1:
+		_init_cv_worker(data, target_column)
+		results = [_run_cv_fold(estimator_fn, hyperparameter, space, train_idx, test_idx, threads_per_fold) 
+			for train_idx, test_idx in folds]
+	else:
+		with ProcessPoolExecutor(max_workers=n_jobs or min(len(folds), os.cpu_count()), 
+		                         mp_context=multiprocessing.get_context('spawn'), initializer=_init_cv_worker, initargs=(data, target_column)) as pool:
+			futures = [pool.submit(_run_cv_fold, estimator_fn, hyperparameter, space, train_idx, test_idx, threads_per_fold) 
+				for train_idx, test_idx in folds]
+			results = [future.result() for future in futures]
+
+	cv_results = pd.DataFrame(results)
+	cv_results.insert(0, 'fold', np.arange(len(folds)))
+	return cv_results
 
 # ------------------------------------------------------------------------------------
 
@@ -39,8 +262,44 @@ XGB_space= {
 }
 
 
+def XGB_trial(space, X_train, y_train, X_test, y_test, n_threads=None, early_stopping_rounds=3):
+	# one tuning trial, module-level so that it can run in the worker processes of parallel_fmin
+	model = XGBRegressor(learning_rate = space['learning_rate'],
+	                     n_estimators = int(space['n_estimators']), 
+	                     max_depth = int(space['max_depth']), 
+	                     min_child_weight = space['min_child_weight'],
+	                     colsample_bytree = space['colsample_bytree'],
+	                     colsample_bylevel = space['colsample_bylevel'],
+	                     objective = space['objective'],
+	                     reg_lambda = space['reg_lambda'],
+	                     reg_alpha = int(space['reg_alpha']), 
+	                     n_jobs = n_threads,
+	                     )
+	
+	evaluation = [(X_train, y_train), (X_test, y_test)]
+	
+	model.fit(X_train, y_train, eval_set=evaluation, eval_metric="mae", early_stopping_rounds=early_stopping_rounds, verbose=False)
+
+	pred = model.predict(X_test)
+	error= mean_absolute_error(y_test, pred)
+
+	# the fitted model is not kept in the trials, only what is needed to compare them
+	return {'loss':error, 'status': STATUS_OK, 'n_trees': model.best_iteration + 1}
+
+
+def XGB_estimator(hyperparameter, space, y_train, n_threads=None):
+	# the final model of a chosen hyperparameter, as built by build_model and the cross validation folds
+	return XGBRegressor(learning_rate = hyperparameter['learning_rate'], 
+		max_depth = int(hyperparameter['max_depth']), 
+		n_estimators = int(hyperparameter['n_estimators']),
+		reg_alpha = int(hyperparameter['reg_alpha']), reg_lambda = hyperparameter['reg_lambda'], 
+		min_child_weight = space['min_child_weight'], 
+		colsample_bytree = space['colsample_bytree'], colsample_bylevel = space['colsample_bylevel'], 
+		objective = space['objective'], eval_metric = 'mae', base_score = np.median(y_train), n_jobs = n_threads)
+
+
 class XGB_model:
-	def __init__(self, df, target, hyperparameter=None, model=None, space=XGB_space, max_evals=50):
+	def __init__(self, df, target, hyperparameter=None, model=None, space=XGB_space, max_evals=50, scaler=None, split=None):
 
 		self.space = space
 		self.hyperparameter = hyperparameter
@@ -49,68 +308,124 @@ class XGB_model:
 		self.df = df
 		self.target = target
 
-		preprocessed_data = preprocess_train_test_data(self.df, target_column=self.target)
-		self.X_train_normalized, self.X_test_normalized, self.y_train, self.y_test = preprocessed_data #tuple unpacking
+		# scaler and split: the fitted scaler and train / test split of a saved model, otherwise fitted / drawn here
+		preprocessed_data = preprocess_train_test_data(self.df, target_column=self.target, scaler=scaler, return_scaler=True, split=split)
+		self.X_train_normalized, self.X_test_normalized, self.y_train, self.y_test, self.scaler = preprocessed_data #tuple unpacking
+		self.split = get_split(self.df, self.X_test_normalized.index)
 		self.df_test_pred = self.df.loc[self.X_test_normalized.index]
+		self.threads_per_trial = None
+		self.trials = None
+		self.rungs = None
+		self.ct_residuals = None
+		self.contributions = None
+		self.cv_results = None
 
 	def XGB_hyperparameter_tuning(self, space):
-	    model = XGBRegressor(learning_rate = space['learning_rate'],
-	                         n_estimators = int(space['n_estimators']), 
-	                         max_depth = int(space['max_depth']), 
-	                         min_child_weight = space['min_child_weight'],
-	                         colsample_bytree = space['colsample_bytree'],
-	                         colsample_bylevel = space['colsample_bylevel'],
-	                         objective = space['objective'],
-	                         reg_lambda = space['reg_lambda'],
-	                         reg_alpha = int(space['reg_alpha']), 
-	                         )
-	    
-	    evaluation = [(self.X_train_normalized, self.y_train), (self.X_test_normalized, self.y_test)]
-	    
-	    model.fit(self.X_train_normalized, self.y_train, eval_set=evaluation, eval_metric="mae", early_stopping_rounds=3, verbose=False)
-
-	    pred = model.predict(self.X_test_normalized)
-	    error= mean_absolute_error(self.y_test, pred)
-
-	    return {'loss':error, 'status': STATUS_OK, 'model': model}
-
-	def find_bestparams(self):
-		self.hyperparameter = fmin(fn = self.XGB_hyperparameter_tuning, space=self.space, algo=tpe.suggest, 
-			max_evals=self.max_evals, trials= Trials())
+		return XGB_trial(space, self.X_train_normalized, self.y_train, self.X_test_normalized, self.y_test, 
+			n_threads=self.threads_per_trial)
+
+	def find_bestparams(self, n_jobs=None, trials_path=None, threads_per_trial=None, seed=None):
+		'''
+		Tunes the hyperparameters with TPE. By default the trials run one after another in this process;
+		with n_jobs and/or trials_path they run over a pool of n_jobs processes with threads_per_trial
+		threads each (default 1), and are persisted to trials_path so an interrupted run can resume.
+		'''
+		self.threads_per_trial = threads_per_trial
+		if n_jobs == None and trials_path == None:
+			self.trials = Trials()
+			self.hyperparameter = fmin(fn = self.XGB_hyperparameter_tuning, space=self.space, algo=tpe.suggest, 
+				max_evals=self.max_evals, trials= self.trials)
+		else:
+			data = (self.X_train_normalized, self.y_train, self.X_test_normalized, self.y_test)
+			self.hyperparameter, self.trials = parallel_fmin(XGB_trial, self.space, data, max_evals=self.max_evals, 
+				n_jobs=n_jobs, trials_path=trials_path, threads_per_trial=threads_per_trial or 1, seed=seed)
+
+	def find_bestparams_halving(self, n_candidates=27, eta=3, max_trees=2000, early_stopping_rounds=20, n_jobs=1, 
+		threads_per_trial=None, seed=None):
+		'''
+		Tunes the hyperparameters with successive halving (see successive_halving) on a validation fold carved from
+		the training data, and sets the same hyperparameter dict as find_bestparams
+		'''
+		data = carve_validation_fold(self.X_train_normalized, self.y_train, self.df.loc[self.X_train_normalized.index, 'ct_key'])
+		self.hyperparameter, self.rungs = successive_halving(XGB_trial, self.space, data, n_candidates=n_candidates, eta=eta, 
+			max_trees=max_trees, early_stopping_rounds=early_stopping_rounds, n_jobs=n_jobs, threads_per_trial=threads_per_trial, seed=seed)
 
 	def build_model(self):
 		if self.hyperparameter == None:
 			return "Pass in the hyperparameter to use, or tune hyperparameter from scratch by executing self.find_bestparams()"
 
-		self.model = XGBRegressor(learning_rate = self.hyperparameter['learning_rate'], 
-			max_depth = int(self.hyperparameter['max_depth']), 
-			n_estimators = int(self.hyperparameter['n_estimators']),
-			reg_alpha = int(self.hyperparameter['reg_alpha']), reg_lambda = self.hyperparameter['reg_lambda'], 
-			min_child_weight = self.space['min_child_weight'], 
-			colsample_bytree = self.space['colsample_bytree'], colsample_bylevel = self.space['colsample_bylevel'], 
-			objective = self.space['objective'], eval_metric = 'mae', base_score = np.median(self.y_train))
+		self.model = XGB_estimator(self.hyperparameter, self.space, self.y_train)
 
 		print(self.model)
 
 		self.model.fit(self.X_train_normalized, self.y_train)
+		self.contributions = None
+		print("\nMAE training:", mean_absolute_error(self.y_train, self.model.predict(self.X_train_normalized)))
+		print("MAE testing:", mean_absolute_error(self.y_test, self.model.predict(self.X_test_normalized)))
+
+	def cross_validate(self, n_splits=5, by='ct_key', n_jobs=None, threads_per_fold=1):
+		'''
+		Per fold MAE and timing of the model with self.hyperparameter over GroupKFold by census tract (by='ct_key')
+		or time-aware folds (by='month'), see cross_validate
+		'''
+		if self.hyperparameter == None:
+			return "Pass in the hyperparameter to use, or tune hyperparameter from scratch by executing self.find_bestparams()"
+
+		self.cv_results = cross_validate(XGB_estimator, self.hyperparameter, self.space, self.df, self.target, n_splits=n_splits, 
+			by=by, n_jobs=n_jobs, threads_per_fold=threads_per_fold)
+		print(f"XGB cross validation MAE - mean:{self.cv_results['mae'].mean():.5f}, st dev:{self.cv_results['mae'].std():.5f}")
+		return self.cv_results
+
+	def continue_training(self, n_new_estimators=100):
+		'''
+		Adds n_new_estimators trees to the fitted model, boosting from it on the current training data
+		(e.g. once new months were added) instead of retraining from scratch
+		'''
+		if self.model == None:
+			return "No model provided. Set self.model=model or train a model from scratch by executing self.build_model()"
+
+		booster = self.model.get_booster()
+		self.model = XGBRegressor(**dict(self.model.get_params(), n_estimators=n_new_estimators))
+		self.model.fit(self.X_train_normalized, self.y_train, xgb_model=booster)
+		self.contributions = None
+		self.hyperparameter = dict(self.hyperparameter, n_estimators=int(self.hyperparameter['n_estimators']) + n_new_estimators)
 		print("\nMAE training:", mean_absolute_error(self.y_train, self.model.predict(self.X_train_normalized)))
 		print("MAE testing:", mean_absolute_error(self.y_test, self.model.predict(self.X_test_normalized)))
 
+	def save(self, registry, name):
+		# saves the booster, scaler, features, hyperparameters and data fingerprint (see model_registry.ModelRegistry)
+		return registry.save(name, self)
+
+	@classmethod
+	def from_registry(cls, df, registry, name, n_new_estimators=100):
+		'''
+		Rebuilds a saved model for df without tuning or retraining: the booster, the scaler and the train / test split
+		are loaded from the registry. If df only adds new months to the data the model was saved with, the rows of the
+		new months are split, the model is boosted further on the train rows (continue_training) and saved again
+		'''
+		entry = registry.get(name)
+		status, new_months = entry.compare(df)
+		if status == 'changed':
+			raise ValueError(f"The data of {name} changed since it was saved, rebuild it with build_model()")
+
+		boosting_model = cls(df, entry.meta['target'], hyperparameter=entry.meta['hyperparameter'], model=entry.model, 
+			scaler=entry.scaler, split=entry.split)
+		if status == 'new_months':
+			print(f"continue training {name} on the new months {new_months}")
+			boosting_model.continue_training(n_new_estimators)
+			boosting_model.save(registry, name)
+		return boosting_model
+
 	def evaluate_model(self, show_plot=True, ax=None):
 
 		if self.model == None:
 			return "No model provided. Set self.model=model or train a model from scratch by executing self.build_model()"
 
-		
-		self.df_test_pred['pred'] = self.model.predict(self.X_test_normalized)
 		self.df_test_pred['pred'] = self.model.predict(self.X_test_normalized)
 
-		XGB_mean_residuals = []
-
-		for ct in self.df_test_pred.ct_key.unique():
-		  mean = np.mean(self.df[self.df['ct_key']==ct][self.target])
-		  pred_XGB = np.mean(self.df_test_pred[self.df_test_pred['ct_key']==ct]['pred'])
-		  XGB_mean_residuals.append(pred_XGB-mean)
+		# per census tract mean of the actual rates vs mean of the test predictions
+		self.ct_residuals = get_ct_residuals(self.df, self.df_test_pred, self.target)
+		XGB_mean_residuals = self.ct_residuals['residual']
 		  
 		print(f"XGboost - mean:{np.mean(XGB_mean_residuals):.5f}, st dev:{np.std(XGB_mean_residuals):.5f}")
 
@@ -125,20 +440,21 @@ class XGB_model:
 		if show_plot:
 			plt.show()
 
-		return XGB_mean_residuals
+		return self.ct_residuals
 
 	def plot_pred_CT(self, samples_ct, ax, plot_distribution=True):
 		if "pred" in self.df_test_pred.columns:
+			ct_residuals = get_ct_residuals(self.df, self.df_test_pred, self.target).reindex(samples_ct)
+			actual_rates = self.df.groupby('ct_key')[self.target]
 			for idx, ct in enumerate(samples_ct):
-				
+
 				if plot_distribution:
 					# plot the distribution of known rates
-					ax[idx//5, idx%5].hist(self.df[self.df['ct_key']==ct][self.target], alpha=0.5, label='actual rates')
-					ax[idx//5, idx%5].axvline(np.mean(self.df[self.df['ct_key']==ct][self.target]), c='k', linestyle=':', label='mean ratio')
+					ax[idx//5, idx%5].hist(actual_rates.get_group(ct), alpha=0.5, label='actual rates')
+					ax[idx//5, idx%5].axvline(np.mean(actual_rates.get_group(ct)), c='k', linestyle=':', label='mean ratio')
 
 				# plot the prediction
-				pred = self.df_test_pred[self.df_test_pred['ct_key']==ct]['pred'].values
-				ax[idx//5, idx%5].axvline(np.mean(pred), c='b',label='XGB pred') #taking the mean because we can have > 1 test points belonging to the same census tract
+				ax[idx//5, idx%5].axvline(ct_residuals.loc[ct, 'pred_mean'], c='b',label='XGB pred') #taking the mean because we can have > 1 test points belonging to the same census tract
 				ax[idx//5, idx%5].legend()
 
 			plt.tight_layout()
@@ -158,11 +474,21 @@ class XGB_model:
 			ax.set_title("XGBoost")
 
 
+	def get_contributions(self, cache_dir=None):
+		'''
+		Returns the ContributionStore of the test set (contribution of each feature for each test data),
+		computed once per fitted model; with cache_dir it is memory-mapped and reused across sessions
+		'''
+		if self.contributions == None:
+			booster = self.model.get_booster()
+			contrib_fn = lambda X: booster.predict(DMatrix(X, feature_names=list(X.columns)), pred_contribs=True)
+			self.contributions = ContributionStore(contrib_fn, self.X_test_normalized, self.df_test_pred['ct_key'], 
+				model_bytes=bytes(booster.save_raw()), cache_dir=cache_dir)
+		return self.contributions
+
 	def plot_feature_contribution(self, sample_idx, n_features = 30, ylabel=""):
 		# output prediction (contribution of each feature for each test data)
-		booster = self.model.get_booster()
-		test_X = DMatrix(self.X_test_normalized, feature_names=self.X_test_normalized.columns)
-		listing_predictions_contrib_XGB = booster.predict(test_X, pred_contribs=True)
+		listing_predictions_contrib_XGB = self.get_contributions().contributions
 
 		# plot contribution
 		fig, axes = plt.subplots(2,1, figsize=(15,10), sharex=True, sharey=True)
@@ -192,8 +518,41 @@ LGBM_space= {
     'reg_alpha' : hp.quniform('reg_alpha', 5, 20, 1),
 }
 
+def LGBM_trial(space, X_train, y_train, X_test, y_test, n_threads=None, early_stopping_rounds=3):
+	# one tuning trial, module-level so that it can run in the worker processes of parallel_fmin
+	model =LGBMRegressor(learning_rate = space['learning_rate'],
+						n_estimators = int(space['n_estimators']), 
+						num_leaves = int(space['num_leaves']), 
+						min_child_weight = space['min_child_weight'],
+						colsample_bytree = space['colsample_bytree'],
+						objective = space['objective'],
+						reg_lambda = space['reg_lambda'],
+						reg_alpha = int(space['reg_alpha']),
+						n_jobs = n_threads if n_threads else -1)
+
+	evaluation = [(X_train, y_train), (X_test, y_test)]
+
+	model.fit(X_train, y_train, eval_set=evaluation, eval_metric="mae", early_stopping_rounds=early_stopping_rounds, verbose=False)
+
+	pred = model.predict(X_test)
+	error= mean_absolute_error(y_test, pred)
+
+	# the fitted model is not kept in the trials, only what is needed to compare them
+	return {'loss':error, 'status': STATUS_OK, 'n_trees': model.best_iteration_}
+
+
+def LGBM_estimator(hyperparameter, space, y_train, n_threads=None):
+	# the final model of a chosen hyperparameter, as built by build_model and the cross validation folds
+	return LGBMRegressor(learning_rate = hyperparameter['learning_rate'], 
+		num_leaves = int(hyperparameter['num_leaves']), n_estimators = int(hyperparameter['n_estimators']),
+		reg_alpha = int(hyperparameter['reg_alpha']), reg_lambda = hyperparameter['reg_lambda'], 
+		min_child_weight = space['min_child_weight'], 
+		colsample_bytree = space['colsample_bytree'], 
+		objective = space['objective'], n_jobs = n_threads if n_threads else -1)
+
+
 class LGBM_model:
-	def __init__(self, df, target, hyperparameter=None, model=None, space=LGBM_space, max_evals=50):
+	def __init__(self, df, target, hyperparameter=None, model=None, space=LGBM_space, max_evals=50, scaler=None, split=None):
 
 		self.space = space
 		self.hyperparameter = hyperparameter
@@ -202,65 +561,124 @@ class LGBM_model:
 		self.df = df
 		self.target = target
 
-		preprocessed_data = preprocess_train_test_data(self.df, target_column=self.target)
-		self.X_train_normalized, self.X_test_normalized, self.y_train, self.y_test = preprocessed_data #tuple unpacking
+		# scaler and split: the fitted scaler and train / test split of a saved model, otherwise fitted / drawn here
+		preprocessed_data = preprocess_train_test_data(self.df, target_column=self.target, scaler=scaler, return_scaler=True, split=split)
+		self.X_train_normalized, self.X_test_normalized, self.y_train, self.y_test, self.scaler = preprocessed_data #tuple unpacking
+		self.split = get_split(self.df, self.X_test_normalized.index)
 		self.df_test_pred = self.df.loc[self.X_test_normalized.index]
+		self.threads_per_trial = None
+		self.trials = None
+		self.rungs = None
+		self.ct_residuals = None
+		self.contributions = None
+		self.cv_results = None
 
 	def LGBM_hyperparameter_tuning(self, space):
-		model =LGBMRegressor(learning_rate = space['learning_rate'],
-							n_estimators = int(space['n_estimators']), 
-							num_leaves = int(space['num_leaves']), 
-							min_child_weight = space['min_child_weight'],
-							colsample_bytree = space['colsample_bytree'],
-							objective = space['objective'],
-							reg_lambda = space['reg_lambda'],
-							reg_alpha = int(space['reg_alpha']))
-
-		evaluation = [(self.X_train_normalized, self.y_train), (self.X_test_normalized, self.y_test)]
-
-		model.fit(self.X_train_normalized, self.y_train, eval_set=evaluation, eval_metric="mae", early_stopping_rounds=3, verbose=False)
-
-		pred = model.predict(self.X_test_normalized)
-		error= mean_absolute_error(self.y_test, pred)
-
-		return {'loss':error, 'status': STATUS_OK, 'model': model}
-
-	def find_bestparams(self):
-		self.hyperparameter = fmin(fn = self.LGBM_hyperparameter_tuning, space=self.space, algo=tpe.suggest, 
-			max_evals=self.max_evals, trials= Trials())
+		return LGBM_trial(space, self.X_train_normalized, self.y_train, self.X_test_normalized, self.y_test, 
+			n_threads=self.threads_per_trial)
+
+	def find_bestparams(self, n_jobs=None, trials_path=None, threads_per_trial=None, seed=None):
+		'''
+		Tunes the hyperparameters with TPE. By default the trials run one after another in this process;
+		with n_jobs and/or trials_path they run over a pool of n_jobs processes with threads_per_trial
+		threads each (default 1), and are persisted to trials_path so an interrupted run can resume.
+		'''
+		self.threads_per_trial = threads_per_trial
+		if n_jobs == None and trials_path == None:
+			self.trials = Trials()
+			self.hyperparameter = fmin(fn = self.LGBM_hyperparameter_tuning, space=self.space, algo=tpe.suggest, 
+				max_evals=self.max_evals, trials= self.trials)
+		else:
+			data = (self.X_train_normalized, self.y_train, self.X_test_normalized, self.y_test)
+			self.hyperparameter, self.trials = parallel_fmin(LGBM_trial, self.space, data, max_evals=self.max_evals, 
+				n_jobs=n_jobs, trials_path=trials_path, threads_per_trial=threads_per_trial or 1, seed=seed)
+
+	def find_bestparams_halving(self, n_candidates=27, eta=3, max_trees=2000, early_stopping_rounds=20, n_jobs=1, 
+		threads_per_trial=None, seed=None):
+		'''
+		Tunes the hyperparameters with successive halving (see successive_halving) on a validation fold carved from
+		the training data, and sets the same hyperparameter dict as find_bestparams
+		'''
+		data = carve_validation_fold(self.X_train_normalized, self.y_train, self.df.loc[self.X_train_normalized.index, 'ct_key'])
+		self.hyperparameter, self.rungs = successive_halving(LGBM_trial, self.space, data, n_candidates=n_candidates, eta=eta, 
+			max_trees=max_trees, early_stopping_rounds=early_stopping_rounds, n_jobs=n_jobs, threads_per_trial=threads_per_trial, seed=seed)
 
 	def build_model(self):
 		if self.hyperparameter == None:
 			return "Pass in the hyperparameter to use, or tune hyperparameter from scratch by executing self.find_bestparams()"
 		
-		self.model = LGBMRegressor(learning_rate = self.hyperparameter['learning_rate'], 
-			num_leaves = int(self.hyperparameter['num_leaves']), n_estimators = int(self.hyperparameter['n_estimators']),
-			reg_alpha = int(self.hyperparameter['reg_alpha']), reg_lambda = self.hyperparameter['reg_lambda'], 
-			min_child_weight = self.space['min_child_weight'], 
-			colsample_bytree = self.space['colsample_bytree'], 
-			objective = self.space['objective'])
-
+		self.model = LGBM_estimator(self.hyperparameter, self.space, self.y_train)
 
 		print(self.model)
 
 		self.model.fit(self.X_train_normalized, self.y_train, eval_metric='mae')
+		self.contributions = None
 		print("\nMAE training:", mean_absolute_error(self.y_train, self.model.predict(self.X_train_normalized)))
 		print("MAE testing:", mean_absolute_error(self.y_test, self.model.predict(self.X_test_normalized)))
 
+	def cross_validate(self, n_splits=5, by='ct_key', n_jobs=None, threads_per_fold=1):
+		'''
+		Per fold MAE and timing of the model with self.hyperparameter over GroupKFold by census tract (by='ct_key')
+		or time-aware folds (by='month'), see cross_validate
+		'''
+		if self.hyperparameter == None:
+			return "Pass in the hyperparameter to use, or tune hyperparameter from scratch by executing self.find_bestparams()"
+
+		self.cv_results = cross_validate(LGBM_estimator, self.hyperparameter, self.space, self.df, self.target, n_splits=n_splits, 
+			by=by, n_jobs=n_jobs, threads_per_fold=threads_per_fold)
+		print(f"LGBM cross validation MAE - mean:{self.cv_results['mae'].mean():.5f}, st dev:{self.cv_results['mae'].std():.5f}")
+		return self.cv_results
+
+	def continue_training(self, n_new_estimators=100):
+		'''
+		Adds n_new_estimators trees to the fitted model, boosting from it on the current training data
+		(e.g. once new months were added) instead of retraining from scratch
+		'''
+		if self.model == None:
+			return "No model provided. Set self.model=model or train a model from scratch by executing self.build_model()"
+
+		booster = self.model.booster_
+		self.model = LGBMRegressor(**dict(self.model.get_params(), n_estimators=n_new_estimators))
+		self.model.fit(self.X_train_normalized, self.y_train, eval_metric='mae', init_model=booster)
+		self.contributions = None
+		self.hyperparameter = dict(self.hyperparameter, n_estimators=int(self.hyperparameter['n_estimators']) + n_new_estimators)
+		print("\nMAE training:", mean_absolute_error(self.y_train, self.model.predict(self.X_train_normalized)))
+		print("MAE testing:", mean_absolute_error(self.y_test, self.model.predict(self.X_test_normalized)))
+
+	def save(self, registry, name):
+		# saves the booster, scaler, features, hyperparameters and data fingerprint (see model_registry.ModelRegistry)
+		return registry.save(name, self)
+
+	@classmethod
+	def from_registry(cls, df, registry, name, n_new_estimators=100):
+		'''
+		Rebuilds a saved model for df without tuning or retraining: the booster, the scaler and the train / test split
+		are loaded from the registry. If df only adds new months to the data the model was saved with, the rows of the
+		new months are split, the model is boosted further on the train rows (continue_training) and saved again
+		'''
+		entry = registry.get(name)
+		status, new_months = entry.compare(df)
+		if status == 'changed':
+			raise ValueError(f"The data of {name} changed since it was saved, rebuild it with build_model()")
+
+		boosting_model = cls(df, entry.meta['target'], hyperparameter=entry.meta['hyperparameter'], model=entry.model, 
+			scaler=entry.scaler, split=entry.split)
+		if status == 'new_months':
+			print(f"continue training {name} on the new months {new_months}")
+			boosting_model.continue_training(n_new_estimators)
+			boosting_model.save(registry, name)
+		return boosting_model
+
 	def evaluate_model(self, show_plot=True, ax=None):
 
 		if self.model == None:
 			return "No model provided. Set self.model=model or train a model from scratch by executing self.build_model()"
-		
-		self.df_test_pred['pred'] = self.model.predict(self.X_test_normalized)
-		self.df_test_pred['pred'] = self.model.predict(self.X_test_normalized)
 
-		LGBM_mean_residuals = []
+		self.df_test_pred['pred'] = self.model.predict(self.X_test_normalized)
 
-		for ct in self.df_test_pred.ct_key.unique():
-		  mean = np.mean(self.df[self.df['ct_key']==ct][self.target])
-		  pred_LGBM = np.mean(self.df_test_pred[self.df_test_pred['ct_key']==ct]['pred'])
-		  LGBM_mean_residuals.append(pred_LGBM-mean)
+		# per census tract mean of the actual rates vs mean of the test predictions
+		self.ct_residuals = get_ct_residuals(self.df, self.df_test_pred, self.target)
+		LGBM_mean_residuals = self.ct_residuals['residual']
 		  
 		print(f"LGBM - mean:{np.mean(LGBM_mean_residuals):.5f}, st dev:{np.std(LGBM_mean_residuals):.5f}")
 
@@ -275,20 +693,21 @@ class LGBM_model:
 		if show_plot:
 			plt.show()
 
-		return LGBM_mean_residuals
+		return self.ct_residuals
 
 	def plot_pred_CT(self, samples_ct, ax, plot_distribution=True):
 		if "pred" in self.df_test_pred.columns:
+			ct_residuals = get_ct_residuals(self.df, self.df_test_pred, self.target).reindex(samples_ct)
+			actual_rates = self.df.groupby('ct_key')[self.target]
 			for idx, ct in enumerate(samples_ct):
 
 				if plot_distribution:
 					# plot the distribution of known rates
-					ax[idx//5, idx%5].hist(self.df[self.df['ct_key']==ct][self.target], alpha=0.5, label='actual rates')
-					ax[idx//5, idx%5].axvline(np.mean(self.df[self.df['ct_key']==ct][self.target]), c='k', linestyle=':', label='mean ratio')
+					ax[idx//5, idx%5].hist(actual_rates.get_group(ct), alpha=0.5, label='actual rates')
+					ax[idx//5, idx%5].axvline(np.mean(actual_rates.get_group(ct)), c='k', linestyle=':', label='mean ratio')
 
 				# plot the prediction
-				pred = self.df_test_pred[self.df_test_pred['ct_key']==ct]['pred'].values
-				ax[idx//5, idx%5].axvline(np.mean(pred), c='r',label='LGBM pred') #taking the mean because we can have > 1 test points belonging to the same census tract
+				ax[idx//5, idx%5].axvline(ct_residuals.loc[ct, 'pred_mean'], c='r',label='LGBM pred') #taking the mean because we can have > 1 test points belonging to the same census tract
 				ax[idx//5, idx%5].legend()
 
 			plt.tight_layout()
@@ -307,10 +726,21 @@ class LGBM_model:
 			ax.set_title("Light GBM")
 
 
+	def get_contributions(self, cache_dir=None):
+		'''
+		Returns the ContributionStore of the test set (contribution of each feature for each test data),
+		computed once per fitted model; with cache_dir it is memory-mapped and reused across sessions
+		'''
+		if self.contributions == None:
+			contrib_fn = lambda X: self.model.predict(X, pred_contrib=True)
+			self.contributions = ContributionStore(contrib_fn, self.X_test_normalized, self.df_test_pred['ct_key'], 
+				model_bytes=self.model.booster_.model_to_string().encode(), cache_dir=cache_dir)
+		return self.contributions
+
 	def plot_feature_contribution(self, sample_idx, n_features = 30, ylabel=""):
 
 		# output prediction (contribution of each feature for each test data)
-		listing_predictions_contrib_LGBM = self.model.predict(self.X_test_normalized, pred_contrib=True)
+		listing_predictions_contrib_LGBM = self.get_contributions().contributions
 
 		# plot contribution
 		fig, axes = plt.subplots(2,1, figsize=(15,10), sharex=True, sharey=True)
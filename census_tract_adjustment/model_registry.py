@@ -0,0 +1,151 @@
+import hashlib
+import json
+import os
+import pickle
+import numpy as np
+import pandas as pd
+from xgboost import XGBRegressor
+from lightgbm import Booster
+
+# ------------------------------------------------------------------------------------
+
+def get_month_fingerprints(df, columns):
+	'''
+	Takes in the census tract dataframe and the columns the model is trained on, and returns a fingerprint
+	of the rows of each month, to tell whether a dataframe only has new months compared to a saved model
+	'''
+	row_hashes = pd.util.hash_pandas_object(df[columns], index=False).values
+	months = df['month'].astype(str).values
+	return {month: hashlib.sha1(np.sort(row_hashes[rows]).tobytes()).hexdigest()
+			for month, rows in pd.Series(months).groupby(months).indices.items()}
+class LGBMBoosterModel:
+	'''
+	A LightGBM booster loaded from its native model file, with the parts of the LGBMRegressor api the models use
+	(predict, booster_, get_params and feature_importances_): the sklearn api of LightGBM can not load a model file.
+	continue_training boosts a new LGBMRegressor with the same parameters from booster_
+	'''
+	def __init__(self, booster, params):
+		self.booster_ = booster
+		self.params = params
+
+	def __repr__(self):
+		return f"LGBMBoosterModel({', '.join(f'{key}={value!r}' for key, value in self.params.items())})"
+
+	def get_params(self, deep=True):
+		return dict(self.params)
+
+	def predict(self, X, **kwargs):
+		return self.booster_.predict(X, **kwargs)
+
+	@property
+	def feature_importances_(self):
+		return self.booster_.feature_importance(importance_type=self.params.get('importance_type') or 'split')
+
+
+class RegisteredModel:
+	'''
+	A model saved in the registry. The metadata (kind, target, feature columns, hyperparameters, estimator
+	parameters and month fingerprints of the training data) is read on creation, the model, the scaler and
+	the train / test split only the first time they are accessed
+	'''
+	def __init__(self, path):
+		self.path = path
+		with open(os.path.join(path, 'meta.json')) as f:
+			self.meta = json.load(f)
+		self._model = None
+		self._scaler = None
+		self._split = None
+
+	@property
+	def model(self):
+		if self._model is None:
+			if self.meta['kind'] == 'XGB':
+				self._model = XGBRegressor(**self.meta['params'])
+				self._model.load_model(os.path.join(self.path, 'model.bin'))
+			else:
+				booster = Booster(model_file=os.path.join(self.path, 'model.txt'))
+				self._model = LGBMBoosterModel(booster, self.meta['params'])
+		return self._model
+
+	@property
+	def scaler(self):
+		if self._scaler is None:
+			with open(os.path.join(self.path, 'scaler.pkl'), 'rb') as f:
+				self._scaler = pickle.load(f)
+		return self._scaler
+
+	@property
+	def split(self):
+		# (ct_key, month, test) rows of the train / test split the model was trained and tested on
+		if self._split is None:
+			self._split = pd.read_csv(os.path.join(self.path, 'split.csv'), dtype={'month': str})
+		return self._split
+
+	def compare(self, df):
+		'''
+		Compares a census tract dataframe with the training data of the model. Returns 'unchanged', 'new_months'
+		(the months of the training data are unchanged and there are new ones) or 'changed', and the new months
+		'''
+		fingerprints = get_month_fingerprints(df, self.meta['fingerprint_columns'])
+		saved = self.meta['month_fingerprints']
+		if any(fingerprints.get(month) != fingerprint for month, fingerprint in saved.items()):
+			return 'changed', []
+		new_months = sorted(set(fingerprints) - set(saved))
+		return ('new_months' if new_months else 'unchanged'), new_months
+
+
+class ModelRegistry:
+	'''
+	Directory of fitted XGB_model / LGBM_model, one sub-directory per name with the booster in its native format
+	(model.bin for XGBoost, model.txt for LightGBM, loaded as a LGBMBoosterModel), the fitted MinMaxScaler
+	(scaler.pkl), the train / test split (split.csv) and meta.json
+	'''
+	def __init__(self, registry_dir):
+		self.registry_dir = registry_dir
+		self._entries = {}
+
+	def names(self):
+		if not os.path.exists(self.registry_dir):
+			return []
+		return sorted(name for name in os.listdir(self.registry_dir) if os.path.exists(os.path.join(self.registry_dir, name, 'meta.json')))
+
+	def get(self, name):
+		if name not in self._entries:
+			self._entries[name] = RegisteredModel(os.path.join(self.registry_dir, name))
+		return self._entries[name]
+
+	def save(self, name, boosting_model):
+		'''
+		Takes in a built XGB_model or LGBM_model and saves it under name, replacing the previous version
+		'''
+		path = os.path.join(self.registry_dir, name)
+		os.makedirs(path, exist_ok=True)
+
+		kind = 'XGB' if isinstance(boosting_model.model, XGBRegressor) else 'LGBM'
+		if kind == 'XGB':
+			boosting_model.model.save_model(os.path.join(path, 'model.bin'))
+		else:
+			boosting_model.model.booster_.save_model(os.path.join(path, 'model.txt'))
+		with open(os.path.join(path, 'scaler.pkl'), 'wb') as f:
+			pickle.dump(boosting_model.scaler, f)
+		boosting_model.split.to_csv(os.path.join(path, 'split.csv'), index=False)
+
+		feature_columns = list(boosting_model.X_train_normalized.columns)
+		fingerprint_columns = [col for col in boosting_model.df.columns if col != 'month']
+		params = {}
+		for key, value in boosting_model.model.get_params().items():
+			value = value.item() if isinstance(value, np.generic) else value
+			if value is None or isinstance(value, (int, float, str, bool)):
+				params[key] = value
+		meta = {'kind': kind,
+				'target': boosting_model.target,
+				'feature_columns': feature_columns,
+				'hyperparameter': {key: float(value) for key, value in boosting_model.hyperparameter.items()},
+				'params': params,
+				'fingerprint_columns': fingerprint_columns,
+				'month_fingerprints': get_month_fingerprints(boosting_model.df, fingerprint_columns)}
+		with open(os.path.join(path, 'meta.json'), 'w') as f:
+			json.dump(meta, f, indent=1)
+
+		self._entries.pop(name, None)
+		return self.get(name)
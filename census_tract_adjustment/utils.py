@@ -1,3 +1,6 @@
+import hashlib
+import os
+import sys
 from io import BytesIO, StringIO
 import requests
 import numpy as np
@@ -7,6 +10,10 @@ import seaborn as sns
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import StandardScaler, MinMaxScaler
 
+# ct_activity / data_store live at the root of the repo
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from ct_activity import compute_ct_activity, get_ct_activity
+
 def load_data(url):
 	'''
 	Takes in url of the shared csv file in google drive, and return a dataframe
@@ -20,74 +27,144 @@ def load_data(url):
 	return df
 
 def preprocess_data(df, listings):
+	'''
+	Takes in the census tract features dataframe and the listings, and returns the monthly listings / sales
+	activity of each census tract merged with its features (see ct_activity.compute_ct_activity).
+	To reuse the table across jobs, use get_ct_activity(market_area, data_dir, stats_columns=None,
+	baseline_tracts='census', cache_dir=...) instead, which reads and caches it by market
+	'''
+	# the overall denver's listing & sales rate only counts census tracts present in the features dataframe
+	return compute_ct_activity(listings, df, sales_count_threshold=10, baseline_tracts='census')
+
+# identifiers, monthly activity and redundant columns of the census tract activity, that are not model features
+redundant_columns = ['homeownership_rate', 'family_households_fraction']
+NON_FEATURE_COLUMNS = ['ct_key', 'pop_density', 'census_population', 'month','ct_count_listings', 'ct_count_sales', 'sales_per_households', 'listings_per_households', 
+                       'ct_listings_per_households', 'ct_sales_per_households', 'relative_listings_toBaseline','relative_sales_toBaseline'] + redundant_columns
+
+def get_feature_matrix(df_merged):
+	'''
+	Takes in the census tract activity merged with the census tract features, and returns the features of the models
+	(the census tract features, without the identifiers, activity columns and redundant features)
+	'''
+	X = df_merged.drop(NON_FEATURE_COLUMNS, axis=1)
+	X.columns = X.columns.str.replace(">","greaterthan").str.replace("<","lessthan")
+	return X
+
+def get_split(df_merged, test_index):
+	'''
+	Takes in the census tract dataframe and the index of its test rows, and returns the train / test split as
+	a (ct_key, month, test) table, which identifies the rows independently of the index of the dataframe
+	'''
+	split = df_merged[['ct_key', 'month']].copy()
+	split['month'] = split['month'].astype(str)
+	split['test'] = df_merged.index.isin(test_index)
+	return split.reset_index(drop=True)
 
-	# preprocess listing dataset
-	listings['ct_key'] = listings['ct_key'].astype('int')
-	listings['sale_month'] = pd.to_datetime(listings['sale_date'])+ pd.offsets.MonthBegin(n=1) - pd.offsets.MonthBegin(n=1)
-	listings['list_month'] = pd.to_datetime(listings['list_date'])+ pd.offsets.MonthBegin(n=1) - pd.offsets.MonthBegin(n=1)
-
-	# get the numbers for listings and sales by census tract
-	num_listings_ct = listings.dropna(subset=['list_month']).groupby(['ct_key', 'list_month']).count()[['property_id']].reset_index()
-	num_listings_ct = num_listings_ct.rename(columns={'property_id':'ct_count_listings', 'list_month':'month'})
-	num_sales_ct = listings.dropna(subset=['sale_month']).groupby(['ct_key', 'sale_month']).count()[['property_id']].reset_index()
-	num_sales_ct = num_sales_ct.rename(columns={'property_id':'ct_count_sales', 'sale_month':'month'})
-	num_sales_listings = pd.merge(num_listings_ct, num_sales_ct, left_on=['month','ct_key'], right_on=['month','ct_key'], how='outer')
-	num_sales_listings = num_sales_listings.fillna(0.)
-
-	# merge with census-tract features dataframe
-	df_merged = pd.merge(df, num_sales_listings, left_on='ct_key', right_on='ct_key')
-
-	# get the listings rate & sales rate by month for each census tract, as well as the overall denver's listing & sales rate 
-	listing_sales_overall = df_merged.groupby(['ct_key','month']).agg({'ct_count_listings':'mean', 'ct_count_sales':'mean'}).reset_index()
-	listing_sales_overall = listing_sales_overall.groupby('month').agg({'ct_count_listings':'sum', 'ct_count_sales':'sum'})
-
-	# sum up number of households for all CT in the house listing dataset and the CT-level feature dataset
-	listing_sales_overall['total_households'] = df[df['ct_key'].isin(num_sales_listings.ct_key.unique())]['total_households'].sum()
-	listing_sales_overall['sales_per_households'] = listing_sales_overall['ct_count_sales']/listing_sales_overall['total_households']
-	listing_sales_overall['listings_per_households'] = listing_sales_overall['ct_count_listings']/listing_sales_overall['total_households']
-	# display(listing_sales_overall.head())
-
-	# merge the overall sales/listings statistics to the census-tract features dataframe 
-	df_merged = pd.merge(df_merged, listing_sales_overall[['sales_per_households', 'listings_per_households']], left_on='month', right_index=True)
-	df_merged['ct_listings_per_households'] = df_merged['ct_count_listings']/df_merged['total_households']
-	df_merged['ct_sales_per_households'] = df_merged['ct_count_sales']/df_merged['total_households']
-	df_merged['relative_listings_toBaseline'] = df_merged['ct_listings_per_households']/df_merged['listings_per_households']
-	df_merged['relative_sales_toBaseline'] = df_merged['ct_sales_per_households']/df_merged['sales_per_households']
-	# df_merged.head()
-
-	# check data for each census tract
-	# some census tract only has <10 data points 
-	droppped_ct = df_merged.groupby('ct_key').count()['ct_count_sales'].reset_index(name='count')
-	droppped_ct = droppped_ct[droppped_ct['count']<10]['ct_key'].values
-
-	# drop census tract with too few data (only 1/2 months of available data)
-	df_merged = df_merged[~df_merged['ct_key'].isin(droppped_ct)]
-
-	return df_merged
-
-def preprocess_train_test_data(df_merged, target_column='relative_listings_toBaseline'):
+def preprocess_train_test_data(df_merged, target_column='relative_listings_toBaseline', scaler=None, return_scaler=False, split=None):
+	'''
+	Splits the data into normalized train and test features and targets. The features are scaled with scaler if
+	given (e.g. the one a saved model was trained with), otherwise with a MinMaxScaler fitted on the train set,
+	which is also returned if return_scaler.
+	With split (a get_split table, e.g. of a saved model), the rows in it keep their side of the split and only
+	the other rows (e.g. of new months) are split, so that rows a model was trained on never become test rows
+	'''
 	# number of unique census tracts in dataset
 	percent_unique = np.ceil(df_merged.ct_key.nunique()/len(df_merged)*1000)/1000. #round up 3 d.p.
 
-	redundant_columns = ['homeownership_rate', 'family_households_fraction']
-	X = df_merged.drop( ['ct_key', 'pop_density', 'census_population', 'month','ct_count_listings', 'ct_count_sales', 'sales_per_households', 'listings_per_households', 
-	                     'ct_listings_per_households', 'ct_sales_per_households', 'relative_listings_toBaseline','relative_sales_toBaseline'] + redundant_columns
-	                   , axis=1)
-	X.columns = X.columns.str.replace(">","greaterthan").str.replace("<","lessthan")
+	X = get_feature_matrix(df_merged)
 
 	y = df_merged[target_column].values
-	X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=percent_unique, random_state=100, stratify = df_merged.ct_key)
-
-	scaler = MinMaxScaler()
-	X_train_normalized = scaler.fit_transform(X_train)
+	if split is None:
+		X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=percent_unique, random_state=100, stratify = df_merged.ct_key)
+	else:
+		keys = pd.MultiIndex.from_arrays([df_merged['ct_key'].values, df_merged['month'].astype(str).values])
+		saved_test = pd.Series(split['test'].values, index=pd.MultiIndex.from_arrays([split['ct_key'].values, split['month'].astype(str).values]))
+		saved_test = saved_test.reindex(keys)
+		is_test = saved_test.fillna(False).values.astype(bool)
+		new_rows = np.flatnonzero(saved_test.isna().values)
+		if len(new_rows) > 1:
+			# the new rows are split in the same proportion, stratified by census tract when there are enough of them
+			ct_keys = pd.Series(df_merged['ct_key'].values[new_rows])
+			n_test = np.ceil(len(new_rows)*percent_unique)
+			stratify = ct_keys.values if ct_keys.value_counts().min() > 1 and n_test >= ct_keys.nunique() else None
+			_, new_test = train_test_split(new_rows, test_size=percent_unique, random_state=100, stratify=stratify)
+			is_test[new_test] = True
+		X_train, X_test, y_train, y_test = X[~is_test], X[is_test], y[~is_test], y[is_test]
+
+	if scaler is None:
+		scaler = MinMaxScaler()
+		scaler.fit(X_train)
+	X_train_normalized = scaler.transform(X_train)
 	X_train_normalized = pd.DataFrame(X_train_normalized, index=X_train.index, columns=X_train.columns)
 
 	X_test_normalized = scaler.transform(X_test)
 	X_test_normalized = pd.DataFrame(X_test_normalized, index=X_test.index, columns=X_test.columns)
 
+	if return_scaler:
+		return X_train_normalized, X_test_normalized, y_train, y_test, scaler
 	return X_train_normalized, X_test_normalized, y_train, y_test
 
 
+def get_ct_residuals(df, df_test_pred, target_column, pred_column='pred'):
+	'''
+	Takes in the full dataframe and the test rows with their predictions, and returns a table indexed by ct_key
+	(in order of appearance in the test rows) with the mean actual target of each census tract over all its rows,
+	the mean prediction over its test rows and the residual (mean prediction - mean actual)
+	'''
+	pred_mean = df_test_pred.groupby('ct_key', sort=False)[pred_column].mean()
+	actual_mean = df.groupby('ct_key')[target_column].mean()
+	ct_residuals = pd.DataFrame({'actual_mean': actual_mean.reindex(pred_mean.index), 'pred_mean': pred_mean})
+	ct_residuals['residual'] = ct_residuals['pred_mean'] - ct_residuals['actual_mean']
+	return ct_residuals
+
+
+class ContributionStore:
+	'''
+	Feature contributions (SHAP values) of a fitted model over a set of rows, computed once with
+	contrib_fn(X) and kept as a float32 (rows x features+1) array, the last column being the intercept.
+	With cache_dir, the array is saved there under a fingerprint of the model and the rows, memory-mapped
+	instead of held in memory, and reused by later stores for the same model and rows
+	'''
+	def __init__(self, contrib_fn, X, ct_keys, model_bytes=b'', cache_dir=None):
+		self.feature_names = X.columns
+		self.ct_keys = np.asarray(ct_keys)
+
+		path = None
+		if cache_dir is not None:
+			key = hashlib.sha1(model_bytes + pd.util.hash_pandas_object(X).values.tobytes()).hexdigest()
+			path = os.path.join(cache_dir, f'contributions_{key}.npy')
+
+		if path is not None and os.path.exists(path):
+			self.contributions = np.load(path, mmap_mode='r')
+		else:
+			self.contributions = np.asarray(contrib_fn(X), dtype=np.float32)
+			if path is not None:
+				os.makedirs(cache_dir, exist_ok=True)
+				np.save(path, self.contributions)
+				self.contributions = np.load(path, mmap_mode='r')
+
+		# positions of the rows of each census tract
+		self.ct_rows = pd.Series(np.arange(len(self.ct_keys))).groupby(self.ct_keys).indices
+
+	def row(self, idx):
+		# contributions of the idx-th row (features then intercept)
+		return self.contributions[idx]
+
+	def tract(self, ct_key):
+		# contributions of all the rows of a census tract
+		return self.contributions[self.ct_rows[ct_key]]
+
+	def top_features(self, idx=None, ct_key=None, k=10):
+		'''
+		Returns the k features with the largest absolute contribution for the idx-th row, or on average over the
+		rows of census tract ct_key, as a Series sorted by decreasing absolute contribution
+		'''
+		contributions = self.row(idx) if ct_key is None else self.tract(ct_key).mean(axis=0)
+		features = np.asarray(contributions[:-1], dtype=float)
+		top = np.argsort(-np.abs(features), kind='stable')[:k]
+		return pd.Series(features[top], index=self.feature_names[top])
+
+
 def plot_contribution(idx, ax, model_top_features, predictions_contrib, X_test):
 	predictions_contrib_sample =  predictions_contrib[idx].flatten()
 	intercept = predictions_contrib_sample[-1]
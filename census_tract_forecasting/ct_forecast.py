@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+
+
+FORECAST_COLUMNS = ['mean_listings_forecast', 'lower_bound_listings_forecast',
+                    'upper_bound_listings_forecast', 'mean_sales_forecast',
+                    'lower_bound_sales_forecast', 'upper_bound_sales_forecast']
+
+
+def get_ratio_params(ct_activity_df, ct_stats_df):
+    """Get the mean / std of the relative listings and sales rates of each census tract, together with its
+    number of households. This only depends on the historical activity, so it is computed once and then
+    reused for every market-level forecast sample."""
+    ratio_param_df = ct_activity_df.groupby('ct_key').agg(
+        {'relative_listings_toBaseline': ['mean', 'std'],
+         'relative_sales_toBaseline': ['mean', 'std']})
+
+    ratio_param_df.columns = ['listings_mean', 'listings_std', 'sales_mean', 'sales_std']
+
+    ratio_param_df = pd.merge(ratio_param_df, ct_stats_df[['ct_key', 'total_households']],
+                              left_index=True, right_on='ct_key', how='inner').set_index('ct_key')
+    return ratio_param_df.sort_index()
+
+
+def get_ratio_bounds(ratio_param_df, alpha_level=0.1):
+    """Get the (tracts,) arrays of per-household ratios for the mean, lower bound and upper bound forecasts
+    of the listings and sales, keyed by the forecast column they produce."""
+    std_multiple = abs(norm.ppf(alpha_level / 2))
+    households = ratio_param_df['total_households'].values.astype(float)
+
+    ratios = {}
+    for activity in ['listings', 'sales']:
+        mean = ratio_param_df[f'{activity}_mean'].values
+        std = ratio_param_df[f'{activity}_std'].values
+        ratios[f'mean_{activity}_forecast'] = mean * households
+        ratios[f'lower_bound_{activity}_forecast'] = np.maximum(0.0, mean - std_multiple * std) * households
+        ratios[f'upper_bound_{activity}_forecast'] = (mean + std_multiple * std) * households
+    return ratios
+
+
+def batched_ct_forecast(ratio_param_df, forecasted_listings_rates, forecasted_sales_rates, alpha_level=0.1,
+                        chunk_size=4096):
+    """Get the census tract-level forecast summary for a whole vector of market-level forecast samples.
+
+    Every forecast column is the outer product of the (samples,) market-level rates and the (tracts,) ratios,
+    i.e. a (samples x tracts) array which is reduced along the sample axis in a single call: the mean for the
+    mean forecasts, and the alpha / 2 and 1 - (alpha / 2) quantiles (floored at zero) for the bounds. Tracts are
+    processed in blocks of `chunk_size` columns to bound the memory of the intermediate array.
+    """
+    forecasted_rates = {'listings': np.asarray(forecasted_listings_rates, dtype=float),
+                        'sales': np.asarray(forecasted_sales_rates, dtype=float)}
+    ratios = get_ratio_bounds(ratio_param_df, alpha_level)
+
+    lower_percentile = alpha_level / 2
+    upper_percentile = 1 - (alpha_level / 2)
+
+    summary = {}
+    for column in FORECAST_COLUMNS:
+        rates = forecasted_rates['listings' if 'listings' in column else 'sales']
+        ratio = ratios[column]
+        reduced = np.empty(len(ratio))
+        for start in range(0, len(ratio), chunk_size):
+            samples = np.multiply.outer(rates, ratio[start:start + chunk_size])
+            if column.startswith('mean'):
+                reduced[start:start + chunk_size] = samples.mean(axis=0)
+            else:
+                percentile = lower_percentile if column.startswith('lower_bound') else upper_percentile
+                # fmax (not maximum) so that NaN quantiles are floored to 0.0 like the builtin max()
+                reduced[start:start + chunk_size] = np.fmax(0.0, np.quantile(samples, percentile, axis=0))
+        summary[column] = reduced
+
+    return pd.DataFrame(summary, index=ratio_param_df.index, columns=FORECAST_COLUMNS)
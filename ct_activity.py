@@ -0,0 +1,119 @@
+"""Monthly listings / sales activity of each census tract, relative to the whole market.
+
+This is the ct_activity table shared by the census tract boosting models
+(census_tract_adjustment/utils.preprocess_data), their evaluation (ct_model_evaluation.ipynb)
+and the census tract forecast (CensusTractForecast): one row per (census tract, month) with the
+tract's listings and sales counts, its households-normalized rates, the market rates and
+relative_listings_toBaseline / relative_sales_toBaseline.
+
+get_ct_activity() reads a market through data_store and memoizes the table, in this process and
+optionally on disk, keyed by the fingerprint of the source files and the thresholds, e.g.
+
+    get_ct_activity('denver', data_dir='../index-team-data', cache_dir='../index-team-data/cache')
+"""
+import hashlib
+import os
+import numpy as np
+import pandas as pd
+from data_store import get_store_path, read_table
+
+LISTING_COLUMNS = ['property_id', 'ct_key', 'list_date', 'sale_date']
+
+_ct_activity_cache = {}
+
+
+def _month_start(dates):
+    # same as pd.to_datetime(dates) + MonthBegin(n=1) - MonthBegin(n=1), without the offset arithmetic
+    dates = pd.to_datetime(dates)
+    return dates.values.astype('datetime64[M]').astype(dates.dtype)
+
+
+def compute_ct_activity(listings, ct_stats, sales_count_threshold=10, last_full_month=None, baseline_tracts='listings'):
+    '''
+    Computes the ct_activity table from the listings (property_id, ct_key, list_date, sale_date) and the
+    census tract data (ct_key, total_households and any other columns to carry along).
+
+    The list and sale events are counted in a single groupby on (ct_key, month). The market rates are the
+    counts summed over all the tracts of the listings (baseline_tracts='listings', as in CensusTractForecast)
+    or only over those with census tract data (baseline_tracts='census', as in preprocess_data).
+    Tracts with fewer than sales_count_threshold months are dropped, and so are the months after
+    last_full_month if it is given.
+    '''
+    listings = listings.dropna(subset=['property_id'])
+    ct_key = listings['ct_key'].values.astype('int')
+    events = pd.DataFrame({'ct_key': np.concatenate([ct_key, ct_key]),
+                           'month': np.concatenate([_month_start(listings['list_date']),
+                                                    _month_start(listings['sale_date'])]),
+                           'is_sale': np.repeat([0., 1.], len(listings))})
+    counts = events.dropna(subset=['month']).groupby(['month', 'ct_key'])['is_sale'].agg(['size', 'sum'])
+    num_sales_listings = pd.DataFrame({'ct_count_listings': counts['size'] - counts['sum'],
+                                       'ct_count_sales': counts['sum']}).reset_index()[
+        ['ct_key', 'month', 'ct_count_listings', 'ct_count_sales']]
+
+    ct_activity_df = pd.merge(ct_stats, num_sales_listings, left_on='ct_key', right_on='ct_key')
+
+    # counts are unique per (ct_key, month), so the market totals are plain sums over the tracts
+    baseline_df = num_sales_listings if baseline_tracts == 'listings' else ct_activity_df.drop_duplicates(['ct_key', 'month'])
+    listing_sales_overall = baseline_df.groupby('month').agg({'ct_count_listings':'sum', 'ct_count_sales':'sum'})
+
+    # sum up number of households for all CT in the house listing dataset and the CT-level feature dataset
+    listing_sales_overall['total_households'] = ct_stats[ct_stats['ct_key'].isin(
+        num_sales_listings.ct_key.unique())]['total_households'].sum()
+    listing_sales_overall['sales_per_households'] = (listing_sales_overall['ct_count_sales'] /
+                                                     listing_sales_overall['total_households'])
+    listing_sales_overall['listings_per_households'] = (listing_sales_overall['ct_count_listings'] /
+                                                        listing_sales_overall['total_households'])
+
+    ct_activity_df = pd.merge(ct_activity_df, listing_sales_overall[['sales_per_households', 'listings_per_households']],
+                              left_on='month', right_index=True)
+    ct_activity_df['ct_listings_per_households'] = ct_activity_df['ct_count_listings'] / ct_activity_df['total_households']
+    ct_activity_df['ct_sales_per_households'] = ct_activity_df['ct_count_sales'] / ct_activity_df['total_households']
+    ct_activity_df['relative_listings_toBaseline'] = (ct_activity_df['ct_listings_per_households'] /
+                                                      ct_activity_df['listings_per_households'])
+    ct_activity_df['relative_sales_toBaseline'] = (ct_activity_df['ct_sales_per_households'] /
+                                                   ct_activity_df['sales_per_households'])
+
+    # drop census tract with too few data (only 1/2 months of available data)
+    months_per_ct = ct_activity_df.groupby('ct_key')['ct_count_sales'].transform('count')
+    ct_activity_df = ct_activity_df[months_per_ct >= sales_count_threshold]
+    if last_full_month is not None:
+        ct_activity_df = ct_activity_df[ct_activity_df['month'] <= pd.Timestamp(last_full_month)]
+    return ct_activity_df
+
+
+def _fingerprint(market_area, table, data_dir):
+    # size and modification time of the source csv, or of the parquet files if only the store exists
+    path = f'{data_dir}/{market_area}/{table}.csv'
+    if os.path.exists(path):
+        paths = [path]
+    else:
+        market_path = f'{get_store_path(table, data_dir)}/market={market_area}'
+        paths = sorted(os.path.join(root, name) for root, _, names in os.walk(market_path) for name in names)
+    return [(os.path.basename(p), os.stat(p).st_size, os.stat(p).st_mtime_ns) for p in paths]
+
+
+def get_ct_activity(market_area, data_dir='index-team-data', sales_count_threshold=10, last_full_month=None,
+                    stats_columns=['ct_key', 'total_households'], baseline_tracts='listings', cache_dir=None):
+    '''
+    Returns the ct_activity table of a market (see compute_ct_activity), computed once per combination of
+    source files and arguments. stats_columns are the census tract columns kept (None: all of them).
+    With cache_dir, the table is also stored as <cache_dir>/ct_activity_<key>.parquet and reused by later runs.
+    '''
+    key = hashlib.sha1(repr([market_area,
+                             _fingerprint(market_area, 'listing_dates_with_ct', data_dir),
+                             _fingerprint(market_area, 'census_tract_data', data_dir),
+                             sales_count_threshold, str(last_full_month), stats_columns, baseline_tracts]).encode()).hexdigest()
+    if key not in _ct_activity_cache:
+        cache_path = None if cache_dir is None else f'{cache_dir}/ct_activity_{key}.parquet'
+        if cache_path is not None and os.path.exists(cache_path):
+            ct_activity_df = pd.read_parquet(cache_path)
+        else:
+            listings = read_table(market_area, 'listing_dates_with_ct', columns=LISTING_COLUMNS, data_dir=data_dir)
+            ct_stats = read_table(market_area, 'census_tract_data', columns=stats_columns, data_dir=data_dir)
+            ct_activity_df = compute_ct_activity(listings, ct_stats, sales_count_threshold, last_full_month, baseline_tracts)
+            if cache_path is not None:
+                os.makedirs(cache_dir, exist_ok=True)
+                ct_activity_df.to_parquet(cache_path)
+        _ct_activity_cache[key] = ct_activity_df
+    # callers add columns to the table, so they get their own copy
+    return _ct_activity_cache[key].copy()
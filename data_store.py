@@ -0,0 +1,95 @@
+"""Columnar storage of the listing and census tract tables of index-team-data/<market_area>/.
+
+Each table is converted once from its CSV into a typed Parquet dataset under
+index-team-data/parquet/<table>/, partitioned by market and (for the listing tables) by
+listing month, e.g. index-team-data/parquet/listing_dates_with_ct/market=denver/list_month=2020-09/.
+Rows without a (valid) listing date go to list_month=0000-00 and read back with a null list_month.
+read_table() then loads a market with column and predicate pushdown, e.g.
+
+    read_table('denver', 'listing_dates_with_ct', columns=['ct_key', 'list_date', 'sale_date'],
+               filters=[('list_month', '>=', '2019-01')], data_dir='../index-team-data')
+
+Run `python data_store.py denver atlanta` after download_s3_folder.py to convert markets up front.
+"""
+import os
+import shutil
+import sys
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+TABLES = {
+    'listing_dates': 'list_date',
+    'listing_dates_cleaned': 'list_date',
+    'listing_dates_with_ct': 'list_date',
+    'census_tract_data': None,
+}  # table name -> date column used for the month partitions (None: partitioned by market only)
+NO_MONTH = '0000-00'  # list_month partition of the rows without a date, sorts before every month in filters
+
+
+def get_store_path(table, data_dir='index-team-data'):
+    return f'{data_dir}/parquet/{table}'
+
+
+def convert_table(market_area, table, data_dir='index-team-data'):
+    '''
+    Converts index-team-data/<market_area>/<table>.csv into the Parquet store, replacing
+    the partitions of that market if it was converted before
+    '''
+    df = pd.read_csv(f'{data_dir}/{market_area}/{table}.csv')
+
+    # parse the dates once here instead of on every read
+    for column in df.columns[df.columns.str.endswith('_date')]:
+        df[column] = pd.to_datetime(df[column], errors='coerce')
+    if 'ct_key' in df.columns and df['ct_key'].notna().all():
+        df['ct_key'] = df['ct_key'].astype('int64')
+
+    partition_cols = ['market']
+    df['market'] = market_area
+    month_column = TABLES[table]
+    if month_column is not None:
+        df['list_month'] = df[month_column].dt.strftime('%Y-%m').fillna(NO_MONTH)
+        partition_cols.append('list_month')
+
+    store_path = get_store_path(table, data_dir)
+    market_path = f'{store_path}/market={market_area}'
+    if os.path.exists(market_path):
+        shutil.rmtree(market_path)
+    pq.write_to_dataset(pa.Table.from_pandas(df, preserve_index=False), store_path, partition_cols=partition_cols)
+
+
+def convert_market(market_area, data_dir='index-team-data', tables=TABLES):
+    for table in tables:
+        if os.path.exists(f'{data_dir}/{market_area}/{table}.csv'):
+            convert_table(market_area, table, data_dir)
+
+
+def read_table(market_area, table, columns=None, filters=None, data_dir='index-team-data'):
+    '''
+    Reads one table of a market from the Parquet store (converting it from the CSV on first use).
+    Only the requested columns and the row groups / partitions matching filters (pyarrow DNF filters,
+    e.g. [('list_month', '>=', '2019-01')]) are read. Returns the columns of the CSV, dates as datetime64
+    '''
+    store_path = get_store_path(table, data_dir)
+    if not os.path.exists(f'{store_path}/market={market_area}'):
+        convert_table(market_area, table, data_dir)
+
+    filters = [('market', '==', market_area)] + list(filters or [])
+    read_columns = None if columns is None else list(dict.fromkeys(columns))
+    # partition values read as plain strings: inferred dictionaries can not be unified across null partitions
+    partition_fields = [('market', pa.string())] + ([('list_month', pa.string())] if TABLES.get(table) is not None else [])
+    partitioning = ds.partitioning(pa.schema(partition_fields), flavor='hive')
+    df = pd.read_parquet(store_path, engine='pyarrow', columns=read_columns, filters=filters, partitioning=partitioning)
+
+    # partition columns are not part of the original table unless explicitly asked for
+    partition_cols = [col for col in ['market', 'list_month'] if col in df.columns and (columns is None or col not in columns)]
+    df = df.drop(columns=partition_cols)
+    if 'list_month' in df.columns:
+        df['list_month'] = df['list_month'].astype(object).where(df['list_month'] != NO_MONTH, None)
+    return df
+
+
+if __name__ == '__main__':
+    for market_area in sys.argv[1:]:
+        convert_market(market_area)
@@ -1,16 +1,264 @@
-import boto3
+"""Incremental download of index-team-data/ from the rex-harvard-iacs S3 bucket.
+
+sync_s3_folder() lists the prefix and compares each object's ETag and size with a local manifest
+(index-team-data/.s3_manifest.json), so only new and changed objects are downloaded. Downloads run in a
+thread pool, large objects as parallel byte ranges, and every file is checked before it replaces the local
+copy: against its ETag (the MD5 of the object, or of its parts for multipart uploads), or, only when the ETag
+can not be checked (SSE-KMS and SSE-C objects, multipart uploads of unknown part size), by its size and
+LastModified. A file that does not match a checkable ETag is not kept, and the previous copy stays in place.
+
+    python download_s3_folder.py                  # fresh clone or daily refresh
+    python download_s3_folder.py --delete         # also remove local files deleted from the bucket
+
+Set S3_ENDPOINT_URL to sync from an S3-compatible server instead of AWS (e.g. a local MinIO or moto server).
+"""
+import argparse
+import hashlib
+import json
 import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+MiB = 1024 * 1024
+MANIFEST_NAME = '.s3_manifest.json'
+
+
+class ChecksumError(Exception):
+    pass
+
+
+def get_s3_client(max_workers=16):
+    return boto3.client('s3', endpoint_url=os.environ.get('S3_ENDPOINT_URL'),
+                        config=Config(max_pool_connections=max_workers, retries={'max_attempts': 5, 'mode': 'standard'}))
+
+
+def list_objects(client, bucket_name, prefix):
+    # key -> {'etag', 'size'} of the objects under prefix
+    objects = {}
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if not obj['Key'].endswith('/'):
+                objects[obj['Key']] = {'etag': obj['ETag'].strip('"'), 'size': obj['Size'],
+                                       'last_modified': obj['LastModified'].isoformat()}
+    return objects
+
+
+def _md5_etag(path, part_size=None):
+    # ETag of the file uploaded in a single part (part_size None) or in parts of part_size bytes
+    with open(path, 'rb') as f:
+        if part_size is None:
+            md5 = hashlib.md5()
+            for block in iter(lambda: f.read(8 * MiB), b''):
+                md5.update(block)
+            return md5.hexdigest()
+        part_md5s = [hashlib.md5(block).digest() for block in iter(lambda: f.read(part_size), b'')]
+    return f"{hashlib.md5(b''.join(part_md5s)).hexdigest()}-{len(part_md5s)}"
+
+
+def matches_etag(path, etag, part_size=None):
+    '''
+    Whether the file has the given S3 ETag. The part size of a multipart upload is not part of the ETag, so unless
+    part_size is given, the usual ones (8 MiB of boto3 and the aws cli, 5, 16 and 64 MiB, and the smallest whole
+    MiB giving the same number of parts) are tried
+    '''
+    if '-' not in etag:
+        return _md5_etag(path) == etag
+    if part_size is not None:
+        return _md5_etag(path, part_size) == etag
+    size = os.path.getsize(path)
+    n_parts = int(etag.split('-')[1])
+    smallest = -(-size // n_parts)
+    candidates = [8 * MiB, 5 * MiB, 16 * MiB, 64 * MiB, -(-smallest // MiB) * MiB]
+    return any(_md5_etag(path, part_size) == etag for part_size in dict.fromkeys(candidates)
+               if -(-size // part_size) == n_parts)
+
+
+def _same_object(obj, saved):
+    # the ETag and size of an object listed now are those of the manifest, and its LastModified too for the
+    # objects whose ETag could not be checked (verified False)
+    if saved is None or saved['etag'] != obj['etag'] or saved['size'] != obj['size']:
+        return False
+    return saved.get('verified', True) or saved.get('last_modified') == obj['last_modified']
+
+
+def _is_encrypted(response):
+    # the ETag of SSE-KMS (and DSSE-KMS) and SSE-C objects is not an MD5 of their content
+    return response.get('ServerSideEncryption', '').startswith('aws:kms') or 'SSECustomerAlgorithm' in response
+
+
+def _part_size(client, bucket_name, key, etag):
+    # size of the first part of a multipart upload (the part size of all but the last), None if the server can not tell
+    try:
+        return client.head_object(Bucket=bucket_name, Key=key, PartNumber=1, IfMatch=f'"{etag}"')['ContentLength']
+    except ClientError:
+        return None
+
+
+class _Download:
+    # an object downloaded into <path>.part by one or more ranges, verified and renamed once all are written
+    def __init__(self, key, etag, size, path, part_size, last_modified=None):
+        self.key, self.etag, self.size, self.path = key, etag, size, path
+        self.last_modified = last_modified
+        self.tmp_path = f'{path}.part'
+        self.ranges = [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)] or [None]
+        self.remaining = len(self.ranges)
+        self.written = 0
+        self.encrypted = False
+        self.verified = None  # whether the ETag could be checked, once downloaded
+        self.lock = threading.Lock()
+
+    def start(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.tmp_path, 'wb') as f:
+            f.truncate(self.size)
+
+    def fetch(self, client, bucket_name, byte_range):
+        kwargs = {'Bucket': bucket_name, 'Key': self.key, 'IfMatch': f'"{self.etag}"'}
+        if byte_range is not None:
+            kwargs['Range'] = 'bytes={}-{}'.format(*byte_range)
+            # IfMatch fails the request if the object changed since it was listed
+            response = client.get_object(**kwargs)
+            self.encrypted = self.encrypted or _is_encrypted(response)
+            if self.last_modified is not None and response['LastModified'].isoformat() != self.last_modified:
+                raise ChecksumError(f'{self.key}: LastModified {response["LastModified"]} differs from the listing')
+            written = 0
+            with open(self.tmp_path, 'r+b') as f:
+                f.seek(byte_range[0])
+                for block in iter(lambda: response['Body'].read(MiB), b''):
+                    written += f.write(block)
+            if written != byte_range[1] - byte_range[0] + 1:
+                raise ChecksumError(f'{self.key}: got {written} bytes for range {byte_range}')
+        else:
+            written = 0
+            self.encrypted = _is_encrypted(client.head_object(**kwargs))
+        with self.lock:
+            self.remaining -= 1
+            self.written += written
+            done = self.remaining == 0
+        if done:
+            if self.written != self.size:
+                raise ChecksumError(f'{self.key}: downloaded {self.written} of {self.size} bytes')
+            self.verified = self.check(client, bucket_name)
+            os.replace(self.tmp_path, self.path)
+        return done
+
+
+    def check(self, client, bucket_name):
+        '''
+        Checks the downloaded file against the ETag. Returns False if the ETag can not be checked (SSE-KMS or SSE-C
+        object, or multipart upload whose part size is neither reported by the server nor one of the usual ones):
+        the file is then only checked by the size of every range, and the LastModified and IfMatch of each request.
+        Raises ChecksumError if the file does not match a checkable ETag
+        '''
+        if self.encrypted:
+            return False
+        part_size = None
+        if '-' in self.etag:
+            part_size = _part_size(client, bucket_name, self.key, self.etag)
+            if part_size is None:
+                return matches_etag(self.tmp_path, self.etag)
+        if not matches_etag(self.tmp_path, self.etag, part_size):
+            raise ChecksumError(f'{self.key}: downloaded file does not match ETag {self.etag}')
+        return True
+
+
+def _save_manifest(manifest, manifest_path):
+    os.makedirs(os.path.dirname(manifest_path) or '.', exist_ok=True)
+    with open(f'{manifest_path}.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(f'{manifest_path}.tmp', manifest_path)
+
+
+def sync_s3_folder(bucket_name, prefix, local_dir='.', max_workers=16, part_size=8 * MiB, delete=False,
+                   client=None, manifest_path=None):
+    '''
+    Downloads the objects under prefix that are new or changed since the last sync to local_dir/<key>.
+    An object is unchanged if its ETag and size are those in the manifest and the local file has that size;
+    local files without a manifest entry (e.g. from a copy made before the manifest) are kept if they match
+    the ETag. With delete, the local files of objects removed from the bucket are deleted (only those the
+    manifest knows of, not files created locally). Returns the downloaded, unchanged, deleted and failed keys,
+    and the downloaded keys whose ETag could not be checked (unverified, kept on their size and LastModified)
+    '''
+    client = get_s3_client(max_workers) if client is None else client
+    manifest_path = os.path.join(local_dir, prefix, MANIFEST_NAME) if manifest_path is None else manifest_path
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    remote = list_objects(client, bucket_name, prefix)
+    local_path = lambda key: os.path.join(local_dir, key)
+    unchanged = [key for key, obj in remote.items() if _same_object(obj, manifest.get(key))
+                 and os.path.exists(local_path(key)) and os.path.getsize(local_path(key)) == obj['size']]
+    candidates = [key for key in remote if key not in unchanged]
+    result = {'downloaded': [], 'unchanged': unchanged, 'deleted': [], 'failed': {}, 'unverified': []}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        # local files unknown to the manifest are hashed instead of downloaded again
+        unknown = {pool.submit(matches_etag, local_path(key), remote[key]['etag']): key for key in candidates
+                   if key not in manifest and os.path.exists(local_path(key))
+                   and os.path.getsize(local_path(key)) == remote[key]['size']}
+        for future in as_completed(unknown):
+            if future.result():
+                key = unknown[future]
+                manifest[key] = remote[key]
+                unchanged.append(key)
+                candidates.remove(key)
+
+        downloads = [_Download(key, remote[key]['etag'], remote[key]['size'], local_path(key), part_size,
+                               remote[key]['last_modified']) for key in candidates]
+        for download in downloads:
+            download.start()
+        futures = {pool.submit(download.fetch, client, bucket_name, byte_range): download
+                   for download in downloads for byte_range in download.ranges}
+        try:
+            for future in as_completed(futures):
+                download = futures[future]
+                try:
+                    if future.result():
+                        manifest[download.key] = remote[download.key]
+                        result['downloaded'].append(download.key)
+                        if not download.verified:
+                            # checked again against the listed LastModified on the next runs
+                            manifest[download.key] = dict(remote[download.key], verified=False)
+                            result['unverified'].append(download.key)
+                except Exception as e:
+                    result['failed'].setdefault(download.key, repr(e))
+        finally:
+            for download in downloads:
+                if download.key in result['failed'] and os.path.exists(download.tmp_path):
+                    os.remove(download.tmp_path)
+            _save_manifest(manifest, manifest_path)
+
+    if delete:
+        for key in [key for key in manifest if key not in remote]:
+            if os.path.exists(local_path(key)):
+                os.remove(local_path(key))
+            del manifest[key]
+            result['deleted'].append(key)
+        _save_manifest(manifest, manifest_path)
+    return result
 
 
-# https://stackoverflow.com/questions/49772151/download-a-folder-from-s3-using-boto3
 def downloadDirectoryFroms3(bucketName, remoteDirectoryName):
-    s3_resource = boto3.resource('s3')
-    bucket = s3_resource.Bucket(bucketName) 
-    for obj in bucket.objects.filter(Prefix = remoteDirectoryName):
-        if not os.path.exists(os.path.dirname(obj.key)):
-            os.makedirs(os.path.dirname(obj.key))
-        if not os.path.exists(obj.key):
-            bucket.download_file(obj.key, obj.key)
+    return sync_s3_folder(bucketName, remoteDirectoryName)
 
-downloadDirectoryFroms3('rex-harvard-iacs', 'index-team-data/')
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Download the new and changed files of index-team-data/ from S3')
+    parser.add_argument('--bucket', default='rex-harvard-iacs')
+    parser.add_argument('--prefix', default='index-team-data/')
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--delete', action='store_true', help='remove local files of objects deleted from the bucket')
+    args = parser.parse_args()
+    result = sync_s3_folder(args.bucket, args.prefix, max_workers=args.workers, delete=args.delete)
+    print(f"{len(result['downloaded'])} downloaded, {len(result['unchanged'])} unchanged, {len(result['deleted'])} deleted")
+    for key in result['unverified']:
+        print(f'ETag not checkable, verified by size and LastModified: {key}')
+    for key, error in result['failed'].items():
+        print(f'failed: {key}: {error}')
+    sys.exit(1 if result['failed'] else 0)
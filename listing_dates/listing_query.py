@@ -0,0 +1,149 @@
+"""Queries of the MLS listings of a market area (query_listing_dates.ipynb).
+
+stream_query() fetches a query in batches of yield_per rows with a server-side cursor and appends each
+batch to a Parquet file (and/or a csv), so only one batch is held in memory:
+
+    q = listing_dates_query(third_party_session, mls_listing, mls_property, market_area_zipcodes, latest_query_date)
+    stream_query(q, f'{data_path}/listing_dates.parquet', csv_path=f'{data_path}/listing_dates.csv')
+
+When only the monthly numbers of listings and sales are needed, get_monthly_counts() lets the database
+aggregate them per zipcode (or any other column, e.g. a census tract column of a joined table) and month.
+
+The tables are passed in, so the queries run the same against the Postgres tables reflected in the notebook
+and against local SQLite tables with the same columns.
+"""
+import itertools
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import sqlalchemy as sa
+
+LISTING_COLUMNS = ['property_id', 'zipcode', 'latitude', 'longitude', 'list_date', 'sale_date', 'withdrawn_date',
+                   'expired_date', 'cancelled_date', 'current_status', 'list_price', 'sale_price']
+
+
+def _filter_listings(query, mls_listing, mls_property, zipcodes, latest_query_date):
+    # listings of the zipcodes listed, and sold if they were, before latest_query_date
+    return (query
+            .filter(mls_property.c.zipcode.in_(zipcodes))
+            .filter(mls_listing.c.original_list_date < latest_query_date)
+            .filter(sa.or_(mls_listing.c.sale_date.is_(None), mls_listing.c.sale_date < latest_query_date)))
+
+
+def listing_dates_query(session, mls_listing, mls_property, zipcodes, latest_query_date):
+    '''
+    Returns the query of the listings of the zipcodes of a market area, with the columns of listing_dates.csv
+    '''
+    columns = [mls_listing.c.cc_property_id, mls_property.c.zipcode, mls_property.c.latitude, mls_property.c.longitude,
+               mls_listing.c.original_list_date, mls_listing.c.sale_date, mls_listing.c.withdrawn_date,
+               mls_listing.c.expired_date, mls_listing.c.cancelled_date, mls_listing.c.current_status,
+               mls_listing.c.original_list_price, mls_listing.c.sale_price]
+    q = (session
+         .query(*[column.label(name) for column, name in zip(columns, LISTING_COLUMNS)])
+         .join(mls_property, mls_property.c.cc_property_id == mls_listing.c.cc_property_id))
+    return _filter_listings(q, mls_listing, mls_property, zipcodes, latest_query_date).order_by(mls_listing.c.original_list_date)
+
+
+def _arrow_type(sql_type):
+    if isinstance(sql_type, sa.Integer):
+        return pa.int64()
+    if isinstance(sql_type, sa.Numeric):
+        return pa.float64()
+    if isinstance(sql_type, sa.DateTime):
+        return pa.timestamp('us')
+    if isinstance(sql_type, sa.Date):
+        return pa.date32()
+    if isinstance(sql_type, sa.Boolean):
+        return pa.bool_()
+    return pa.string()
+
+
+def _arrow_array(values, arrow_type):
+    # Numeric columns come back as Decimal and string columns may hold other types, so they are converted here
+    if arrow_type == pa.float64():
+        values = [None if value is None else float(value) for value in values]
+    elif arrow_type == pa.string():
+        values = [None if value is None else str(value) for value in values]
+    return pa.array(values, type=arrow_type)
+
+
+def stream_query(query, path, yield_per=50000, csv_path=None):
+    '''
+    Writes the rows of query to path (Parquet, or csv if path ends with .csv), fetching yield_per rows at a time
+    with a server-side cursor. The Parquet schema is taken from the column types of the query, so that a batch
+    of only NULL values has the same types as the others. With csv_path, the same batches are also written to
+    that csv, e.g. the listing_dates.csv read by relistings.clean_listing_dates_csv and data_store, without
+    running the query twice. The files are written under a temporary name and renamed once complete.
+    Returns the number of rows written
+    '''
+    names = [description['name'] for description in query.column_descriptions]
+    schema = pa.schema([(description['name'], _arrow_type(description['type'])) for description in query.column_descriptions])
+    rows = iter(query.execution_options(stream_results=True).yield_per(yield_per))
+
+    if path.endswith('.csv'):
+        path, csv_path = None, path
+    tmp_paths = {output_path: f'{output_path}.tmp' for output_path in [path, csv_path] if output_path is not None}
+    writer = None if path is None else pq.ParquetWriter(tmp_paths[path], schema)
+
+    def write_batch(batch, header):
+        if csv_path is not None:
+            pd.DataFrame(batch, columns=names).to_csv(tmp_paths[csv_path], mode='w' if header else 'a', header=header, index=False)
+        if writer is not None:
+            columns = list(zip(*batch)) if batch else [[] for _ in names]
+            writer.write_table(pa.Table.from_arrays([_arrow_array(values, field.type)
+                                                     for values, field in zip(columns, schema)], schema=schema))
+
+    n_rows = 0
+    try:
+        for batch in iter(lambda: list(itertools.islice(rows, yield_per)), []):
+            write_batch(batch, header=n_rows == 0)
+            n_rows += len(batch)
+        if n_rows == 0:
+            write_batch([], header=True)
+    finally:
+        if writer is not None:
+            writer.close()
+    for output_path, tmp_path in tmp_paths.items():
+        os.replace(tmp_path, output_path)
+    return n_rows
+
+
+def _month(column, dialect_name):
+    # 'YYYY-MM' of a date column
+    if dialect_name == 'sqlite':
+        return sa.func.strftime('%Y-%m', column)
+    if dialect_name == 'mysql':
+        return sa.func.date_format(column, '%Y-%m')
+    return sa.func.to_char(column, 'YYYY-MM')
+
+
+def get_monthly_counts(session, mls_listing, mls_property, zipcodes, latest_query_date, group_column=None, joins=()):
+    '''
+    Returns the number of listings (by month of original_list_date) and sales (by month of sale_date) of the
+    listings of listing_dates_query, aggregated in the database per group_column (default: the zipcode) and month.
+    joins are (table, onclause) pairs joined to the listings, to group by a column of another table.
+    Columns: group (named after group_column), month ('YYYY-MM'), count_list, count_sale
+    '''
+    group_column = mls_property.c.zipcode if group_column is None else group_column
+    dialect_name = session.bind.dialect.name
+
+    def events(date_column, count_list, count_sale):
+        q = (session
+             .query(group_column.label('group_key'), _month(date_column, dialect_name).label('month'),
+                    sa.literal(count_list).label('count_list'), sa.literal(count_sale).label('count_sale'))
+             .select_from(mls_listing)
+             .join(mls_property, mls_property.c.cc_property_id == mls_listing.c.cc_property_id))
+        for table, onclause in joins:
+            q = q.join(table, onclause)
+        q = _filter_listings(q, mls_listing, mls_property, zipcodes, latest_query_date)
+        return q.filter(date_column.isnot(None)).statement
+
+    union = sa.union_all(events(mls_listing.c.original_list_date, 1, 0), events(mls_listing.c.sale_date, 0, 1)).alias('events')
+    q = (session
+         .query(union.c.group_key, union.c.month, sa.func.sum(union.c.count_list), sa.func.sum(union.c.count_sale))
+         .group_by(union.c.group_key, union.c.month)
+         .order_by(union.c.group_key, union.c.month))
+    counts = pd.DataFrame(q.all(), columns=[group_column.name, 'month', 'count_list', 'count_sale'])
+    counts[['count_list', 'count_sale']] = counts[['count_list', 'count_sale']].astype('int64')
+    return counts
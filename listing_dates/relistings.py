@@ -0,0 +1,103 @@
+"""Removal of relisted homes from the MLS listing dates (process_listing_dates.ipynb).
+
+A home that goes on the market again within days_cutoff days of its previous listing is only
+counted once: of the consecutive list dates of each property_id, every listing that comes less
+than days_cutoff days after the previous one is dropped.
+
+drop_relistings() filters a listing_dates DataFrame in memory with one sort and a groupby diff.
+clean_listing_dates_csv() does the whole cleaning of process_listing_dates.ipynb (listings in
+the past, then drop_relistings) on a csv that does not fit in memory, e.g.
+
+    clean_listing_dates_csv('../index-team-data/boston/listing_dates.csv',
+                            '../index-team-data/boston/listing_dates_cleaned.csv')
+
+Listings of a property on the same day are ordered as in the file, so the first of them is kept.
+"""
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+EVENT_COLUMNS = ['list_date', 'sale_date', 'withdrawn_date', 'expired_date', 'cancelled_date']
+
+
+def _relisting_gaps(property_id, list_date):
+    # days since the previous listing of the same property (NaN for the first one), in the order of the inputs
+    listings = pd.DataFrame({'property_id': property_id, 'list_date': list_date})
+    listings = listings.sort_values('list_date', kind='stable')
+    gaps = listings.groupby('property_id', sort=False)['list_date'].diff().dt.days
+    return gaps.sort_index().values
+
+
+def get_relisting_gaps(listing_dates_df):
+    '''
+    Returns the number of days between each listing and the previous listing of the same property_id
+    (NaN for the first listing of a property), indexed like listing_dates_df
+    '''
+    list_date = pd.to_datetime(listing_dates_df['list_date']).dt.normalize()
+    gaps = _relisting_gaps(listing_dates_df['property_id'].values, list_date.values)
+    return pd.Series(gaps, index=listing_dates_df.index, name='days_later')
+
+
+def drop_relistings(listing_dates_df, days_cutoff=365):
+    '''
+    Drops the listings of a property_id that come less than days_cutoff days after its previous listing
+    '''
+    return listing_dates_df[~(get_relisting_gaps(listing_dates_df) < days_cutoff)]
+
+
+def _is_past(chunk, today):
+    # listed, and sold if it was, before today
+    return ((chunk['list_date'] < today) & ((chunk['sale_date'] < today) | chunk['sale_date'].isna())).values
+
+
+def clean_listing_dates_csv(input_path, output_path, days_cutoff=365, today=None, chunksize=1000000, n_buckets=32):
+    '''
+    Writes the listings of input_path listed (and sold) before today, without the relistings within
+    days_cutoff days, to output_path, reading chunksize rows at a time.
+
+    The property_id, list_date and row number of the listings are first spilled to n_buckets temporary files
+    by property_id, so that each bucket holds all the listings of its properties and is filtered with
+    drop_relistings' sort and groupby diff. The rows to drop are then removed while streaming the file again.
+    Columns other than the dates are copied as they are in the input file.
+    '''
+    today = pd.Timestamp.today().normalize() if today is None else pd.Timestamp(today)
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(output_path)))
+    try:
+        bucket_paths = [os.path.join(tmp_dir, f'bucket_{bucket}.csv') for bucket in range(n_buckets)]
+        offset = 0
+        for chunk in pd.read_csv(input_path, usecols=['property_id', 'list_date', 'sale_date'],
+                                 dtype={'property_id': str}, chunksize=chunksize):
+            rows = np.arange(offset, offset + len(chunk))
+            offset += len(chunk)
+            list_date = pd.to_datetime(chunk['list_date']).dt.normalize()
+            past = _is_past(pd.DataFrame({'list_date': list_date, 'sale_date': pd.to_datetime(chunk['sale_date'])}), today)
+            spill = pd.DataFrame({'row': rows[past], 'property_id': chunk['property_id'].values[past],
+                                  'list_date': list_date.values[past].astype('datetime64[D]').astype('int64')})
+            buckets = pd.util.hash_array(spill['property_id'].fillna('').values.astype(object)) % n_buckets
+            for bucket, bucket_rows in spill.groupby(buckets).indices.items():
+                spill.iloc[bucket_rows].to_csv(bucket_paths[bucket], mode='a', index=False,
+                                               header=not os.path.exists(bucket_paths[bucket]))
+
+        keep = np.zeros(offset, dtype=bool)
+        for bucket_path in bucket_paths:
+            if not os.path.exists(bucket_path):
+                continue
+            spill = pd.read_csv(bucket_path, dtype={'property_id': str})
+            gaps = _relisting_gaps(spill['property_id'].values, spill['list_date'].values.astype('datetime64[D]'))
+            keep[spill['row'].values[~(gaps < days_cutoff)]] = True
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    offset = 0
+    header = True
+    for chunk in pd.read_csv(input_path, dtype=str, keep_default_na=False, na_values=[''], chunksize=chunksize):
+        chunk_keep = keep[offset:offset + len(chunk)]
+        offset += len(chunk)
+        chunk = chunk[chunk_keep]
+        for column in EVENT_COLUMNS:
+            if column in chunk.columns:
+                chunk[column] = pd.to_datetime(chunk[column]).dt.strftime('%Y-%m-%d')
+        chunk.to_csv(output_path, mode='w' if header else 'a', header=header, index=False)
+        header = False
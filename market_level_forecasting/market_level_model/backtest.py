@@ -0,0 +1,108 @@
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+
+
+def _run_window(model, i, x, y, y_test):
+    #fit and forecast a single walk-forward window (runs in a worker process)
+    start = time.perf_counter()
+    pred, scale, samples = model.predict_window(x, y)
+    fit_seconds = time.perf_counter() - start
+
+    pred = np.asarray(pred, dtype=float)
+    window = pd.DataFrame({'window':i,
+                           'horizon':np.arange(1, len(pred)+1),
+                           'y_pred':pred,
+                           'scale':np.asarray(scale, dtype=float),
+                           'y_true':np.nan,
+                           'fit_seconds':fit_seconds})
+    y_test = np.asarray(y_test, dtype=float)[:len(pred)]
+    window.loc[:len(y_test)-1, 'y_true'] = y_test
+
+    #first stage of rollingCombinedModel, before blending with params
+    components = getattr(model, 'window_components', None)
+    if components is not None:
+        for column, values in components.items():
+            window[column] = np.nan
+            window.loc[:len(values)-1, column] = values
+    return window
+
+
+class walkForwardBacktest(object):
+    """Walk-forward backtest of rollingModel, rollingTimeSeriesModel or rollingCombinedModel.
+
+    The training windows of model.get_windows() are fitted in parallel worker processes
+    (n_jobs=1 runs them in this process) and every (window, horizon) forecast is scored
+    against the following months into one results table: y_true, y_pred, scale, abs_error,
+    sq_error, whether y_true falls in the 1-alpha normal interval (covered) and the time spent
+    fitting the window. For rollingCombinedModel the unblended first stage is kept too, so
+    sweep_params() can score other params blends of it without refitting.
+    """
+    def __init__(self, model, n_jobs=None, alpha=0.1, name=None):
+        self.model = model
+        self.n_jobs = n_jobs
+        self.alpha = alpha
+        self.name = name if name is not None else type(model).__name__
+        self.results = None
+
+    def run(self, start_predict_group, end_predict_group, path=None):
+        groups_train, groups_test = self.model.get_windows()
+        tasks = [(i, groups_train[i][0], groups_train[i][1], groups_test[i][1])
+                 for i in range(start_predict_group, end_predict_group)]
+
+        if self.n_jobs == 1:
+            windows = [_run_window(self.model, *task) for task in tasks]
+        else:
+            #spawn rather than fork: tensorflow is not fork-safe once initialized
+            with ProcessPoolExecutor(max_workers=self.n_jobs, mp_context=multiprocessing.get_context('spawn')) as pool:
+                futures = [pool.submit(_run_window, self.model, *task) for task in tasks]
+                windows = [future.result() for future in futures]
+
+        results = pd.concat(windows, ignore_index=True)
+        results.insert(0, 'model', self.name)
+        self.results = score_predictions(results, self.alpha)
+        if path is not None:
+            self.results.to_csv(path, index=False)
+        return self.results
+
+    def summary(self,):
+        return summarize(self.results)
+
+
+def score_predictions(results, alpha=0.1, pred_column='y_pred', scale_column='scale'):
+    results = results.copy()
+    std_multiple = abs(norm.ppf(alpha / 2))
+    error = results[pred_column] - results['y_true']
+    results['abs_error'] = error.abs()
+    results['sq_error'] = error**2
+    results['covered'] = (error.abs() <= std_multiple*results[scale_column]).where(results['y_true'].notna())
+    return results
+
+
+def summarize(results, by=['model', 'horizon']):
+    #MAE / MSE / interval coverage per horizon, over the windows with an observed target
+    results = results.dropna(subset=['y_true'])
+    return results.groupby(by).agg(mae=('abs_error', 'mean'), mse=('sq_error', 'mean'),
+                                   coverage=('covered', 'mean'), windows=('window', 'nunique'),
+                                   fit_seconds=('fit_seconds', 'mean'))
+
+
+def sweep_params(results, params_grid, alpha=0.1):
+    """Score params blends of the first stage of rollingCombinedModel from backtest results.
+
+    Only the horizons of the first stage (up to predict_horizon) can be re-blended: the later
+    horizons are forecasted from the blended series and need a refit for each params.
+    """
+    first_stage = results.dropna(subset=['y_true', 'pred_linear', 'pred_ts'])
+    summaries = []
+    for params in params_grid:
+        blended = first_stage.copy()
+        blended['y_pred'] = params[0]*blended['pred_linear'] + params[1]*blended['pred_ts']
+        blended['scale'] = params[0]*blended['scale_linear'] + params[1]*blended['scale_ts']
+        summary = summarize(score_predictions(blended, alpha)).reset_index()
+        summary.insert(1, 'params', [tuple(params)]*len(summary))
+        summaries.append(summary)
+    return pd.concat(summaries, ignore_index=True)
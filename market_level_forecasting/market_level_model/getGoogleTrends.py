@@ -1,12 +1,177 @@
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
-from pytrends.request import TrendReq
+import requests
+from requests.adapters import HTTPAdapter
+from pytrends.request import TrendReq, BASE_TRENDS_URL
+from pytrends.exceptions import ResponseError
 from sklearn.preprocessing import MinMaxScaler
 
+
+class TokenBucket(object):
+    """Allows rate requests per second on average, in bursts of up to capacity requests."""
+    def __init__(self, rate=1., capacity=5):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class _TrendReq(TrendReq):
+    #TrendReq sending its requests through the session and rate limit of a TrendsFetcher
+    def __init__(self, fetcher):
+        self.fetcher = fetcher
+        super(_TrendReq, self).__init__(hl=fetcher.hl, tz=fetcher.tz, timeout=fetcher.timeout)
+
+    def GetGoogleCookie(self):
+        return {}
+
+    def _get_data(self, url, method=TrendReq.GET_METHOD, trim_chars=0, **kwargs):
+        return self.fetcher.request(url, method, trim_chars, **kwargs)
+
+
+class TrendsFetcher(object):
+    """Fetches Google Trends interest over time of keyword groups.
+
+    All the requests share one requests.Session (and its Google cookie), go through a token bucket of
+    rate requests per second, and are retried with exponential backoff on 429 / 5xx responses and
+    connection errors. fetch_all() runs the fetches in a thread pool of max_workers threads.
+    With cache_dir, each result is stored on disk keyed by (keyword group, geo, timeframe, repetition),
+    so reruns only fetch what is missing. base_url points the fetcher to another server (e.g. a local stub).
+    """
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, hl='en-US', tz=300, max_workers=4, rate=1., burst=5, retries=5, backoff_factor=2.,
+                 cache_dir=None, base_url=BASE_TRENDS_URL, timeout=(5, 30)):
+        self.hl = hl
+        self.tz = tz
+        self.max_workers = max_workers
+        self.bucket = TokenBucket(rate, burst)
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.cache_dir = cache_dir
+        self.base_url = base_url
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update({'accept-language': hl})
+        self.session.mount(base_url, HTTPAdapter(pool_connections=1, pool_maxsize=max_workers))
+        self.cookie_lock = threading.Lock()
+        self.has_cookie = False
+
+    def _get_cookie(self):
+        #the NID cookie of the explore page is kept by the session for all the later requests
+        with self.cookie_lock:
+            if not self.has_cookie:
+                self.bucket.acquire()
+                self.session.get(f'{self.base_url}/explore/?geo={self.hl[-2:]}', timeout=self.timeout)
+                self.has_cookie = True
+
+    def request(self, url, method='get', trim_chars=0, **kwargs):
+        self._get_cookie()
+        self.bucket.acquire()
+        response = self.session.request(method, self.base_url + url[len(BASE_TRENDS_URL):], timeout=self.timeout, **kwargs)
+        content_type = response.headers.get('Content-Type', '')
+        if response.status_code == 200 and any(t in content_type for t in ['application/json', 'javascript']):
+            return json.loads(response.text[trim_chars:])
+        raise ResponseError(f'The request failed: Google returned a response with code {response.status_code}', response)
+
+    def _cache_path(self, kw_list, geo, timeframe, repetition):
+        key = hashlib.sha1(json.dumps([list(kw_list), geo, timeframe, repetition]).encode()).hexdigest()
+        return os.path.join(self.cache_dir, f'{key}.pkl')
+
+    def fetch(self, kw_list, geo, timeframe, repetition=0):
+        """Returns the interest over time of kw_list (TrendReq.interest_over_time). repetition tells apart
+        repeated fetches of the same payload, which Google answers with different samples"""
+        cache_path = None if self.cache_dir is None else self._cache_path(kw_list, geo, timeframe, repetition)
+        if cache_path is not None and os.path.exists(cache_path):
+            return pd.read_pickle(cache_path)
+        for attempt in range(self.retries + 1):
+            try:
+                pytrends = _TrendReq(self)
+                pytrends.build_payload(list(kw_list), cat=0, timeframe=timeframe, geo=geo)
+                df = pytrends.interest_over_time()
+                break
+            except (ResponseError, requests.exceptions.RequestException) as e:
+                status = getattr(getattr(e, 'response', None), 'status_code', None)
+                if attempt == self.retries or (status is not None and status not in self.RETRY_STATUS):
+                    raise
+                time.sleep(self.backoff_factor * 2**attempt * (1 + random.random()))
+        if cache_path is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            df.to_pickle(f'{cache_path}.tmp')
+            os.replace(f'{cache_path}.tmp', cache_path)
+        return df
+
+    def fetch_all(self, payloads):
+        """payloads: list of (kw_list, geo, timeframe, repetition). Returns their interest over time, in order"""
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            return list(pool.map(lambda payload: self.fetch(*payload), payloads))
+
+
+def plan_payloads(keywords, anchor, size=5):
+    """Packs the terms of keywords (strings and lists of strings) into payloads of size terms: size-1 terms
+    and the anchor term, which is in every payload to put them all on the same scale"""
+    terms = [term for keyword in keywords for term in (keyword if type(keyword) == list else [keyword])]
+    terms = [term for term in dict.fromkeys(terms) if term != anchor]
+    return [terms[i:i+size-1] + [anchor] for i in range(0, len(terms), size-1)]
+
+def unpack_payloads(kw_lists, pytrends_dfs, anchor):
+    """Returns the interest over time of all the terms of the payloads of plan_payloads, each payload rescaled
+    by the ratio of the anchor's total interest in the first payload to its total in that payload"""
+    reference = pytrends_dfs[0][anchor].sum() if len(pytrends_dfs[0]) != 0 else 0
+    if reference == 0:
+        raise ValueError(f'no interest in the anchor term {anchor!r}, use a more searched anchor')
+    terms_dfs = [pytrends_dfs[0][[anchor]].astype(float)]
+    for kw_list, pytrends_df in zip(kw_lists, pytrends_dfs):
+        if len(pytrends_df) == 0 or pytrends_df[anchor].sum() == 0:
+            raise ValueError(f'no interest in the anchor term {anchor!r} with {kw_list}, use a more searched anchor')
+        terms_dfs.append(pytrends_df[kw_list[:-1]] * (reference / pytrends_df[anchor].sum()))
+    return pd.concat(terms_dfs, axis=1)
+
+def group_terms(keywords, terms_df):
+    """Splits the interest of the terms into one frame per keyword (group) of keywords, scaled to a maximum of 100
+    over its terms as when the group is fetched on its own. Groups without any interest get an empty frame"""
+    dfs = []
+    for keyword in keywords:
+        kw_list = keyword if type(keyword) == list else [keyword]
+        group_max = terms_df[kw_list].values.max()
+        dfs.append(terms_df[kw_list] / group_max * 100 if group_max > 0 else pd.DataFrame())
+    return dfs
+
+
 class getGoogleTrendsData(object):
-    def __init__(self,geo='US-CO',city='Atlanta'):
+    """Monthly Google Trends interest of the keywords of a market.
+
+    Each keyword group (or single keyword) is one payload by default. With an anchor term, the terms of all the
+    groups are packed into 5-term payloads that share the anchor (plan_payloads), rescaled to the anchor's scale
+    and split back into the groups. This needs 4x fewer payloads for the terms, but a term much less searched than
+    the anchor comes back as few distinct integer values, so the anchor should be a moderately searched term.
+    """
+    def __init__(self,geo='US-CO',city='Atlanta',fetcher=None,cache_dir=None,anchor=None):
         self.geo = geo
         self.city = city
+        self.fetcher = TrendsFetcher(cache_dir=cache_dir) if fetcher is None else fetcher
+        self.anchor = anchor
         self.keywords = [
     ['homes for sale', 'homes for sale in', 'properties for sale','for sale home','homes for sales'], #home for sale
     ['townhomes for sale','townhouses for sale','townhouse for sale'], #townhomes for sale
@@ -54,31 +219,42 @@ class getGoogleTrendsData(object):
     def set_keywords(self, keywords):
         self.keywords = keywords
     
-    def get_keyword_to_time_series(self,return_columns = False):
+    def _to_time_series(self, pytrends_dfs):
+        #monthly means of the interest over time of each keyword (group), in the order of self.keywords
         keyword_to_time_series = {}
         grouper = pd.Grouper(level='date', freq='M')
         keywords_columns = []
-        for keyword in self.keywords:
+        for keyword, pytrends_df in zip(self.keywords, pytrends_dfs):
+            if len(pytrends_df) == 0:
+                continue
             if type(keyword) == list:
-                pytrends = TrendReq(hl='en-US', tz=300)
-                pytrends.build_payload(keyword, cat=0, timeframe=self.date, geo=self.geo)
-                pytrends_df = pytrends.interest_over_time()
-                if len(pytrends_df)!=0: 
-                    pytrends_monthly_df = pytrends_df.groupby(grouper)[keyword].mean().reset_index()
-                    time_series = np.mean(np.array(pytrends_monthly_df[keyword]),axis=1)
-                    keyword_to_time_series[keyword[0]] = time_series
-                    keywords_columns.append(keyword[0])
-                    #print(keyword)
+                pytrends_monthly_df = pytrends_df.groupby(grouper)[keyword].mean().reset_index()
+                time_series = np.mean(np.array(pytrends_monthly_df[keyword]),axis=1)
+                keyword_to_time_series[keyword[0]] = time_series
+                keywords_columns.append(keyword[0])
             else:
-                pytrends = TrendReq(hl='en-US', tz=300)
-                pytrends.build_payload([keyword], cat=0, timeframe=self.date, geo=self.geo)
-                pytrends_df = pytrends.interest_over_time()
-                if len(pytrends_df)!=0: 
-                    pytrends_monthly_df = pytrends_df.groupby(grouper)[keyword].mean().reset_index()
-                    time_series = np.array(pytrends_monthly_df[keyword])
-                    keyword_to_time_series[keyword] = time_series
-                    keywords_columns.append(keyword)
+                pytrends_monthly_df = pytrends_df.groupby(grouper)[keyword].mean().reset_index()
+                time_series = np.array(pytrends_monthly_df[keyword])
+                keyword_to_time_series[keyword] = time_series
+                keywords_columns.append(keyword)
+        return keyword_to_time_series, keywords_columns
 
+    def _payloads(self, repetition=0):
+        if self.anchor is None:
+            kw_lists = [keyword if type(keyword) == list else [keyword] for keyword in self.keywords]
+        else:
+            kw_lists = plan_payloads(self.keywords, self.anchor)
+        return [(kw_list, self.geo, self.date, repetition) for kw_list in kw_lists]
+
+    def _keyword_dfs(self, payloads, pytrends_dfs):
+        #interest over time of each keyword (group) of self.keywords from the fetched payloads
+        if self.anchor is None:
+            return pytrends_dfs
+        return group_terms(self.keywords, unpack_payloads([payload[0] for payload in payloads], pytrends_dfs, self.anchor))
+
+    def get_keyword_to_time_series(self,return_columns = False,repetition=0):
+        payloads = self._payloads(repetition)
+        keyword_to_time_series, keywords_columns = self._to_time_series(self._keyword_dfs(payloads, self.fetcher.fetch_all(payloads)))
         if return_columns == True:
             return keyword_to_time_series, keywords_columns
         else:
@@ -86,17 +262,65 @@ class getGoogleTrendsData(object):
 
     def get_data(self,times=1,date='2016-03-01 2020-09-30',scaled=True):
         self.date = date
-        keyword_to_time_series, keywords_columns = self.get_keyword_to_time_series(return_columns=True)
+        #the payloads of all the repetitions are fetched concurrently
+        payloads = [payload for i in range(max(times, 1)) for payload in self._payloads(i)]
+        pytrends_dfs = self.fetcher.fetch_all(payloads)
+        n = len(self._payloads())
+        keyword_to_time_series, keywords_columns = self._to_time_series(self._keyword_dfs(payloads[:n], pytrends_dfs[:n]))
         if times >= 1:
-            for i in range(times-1):
-                keyword_to_time_series_1 = self.get_keyword_to_time_series()
+            for i in range(1, times):
+                keyword_to_time_series_1, _ = self._to_time_series(self._keyword_dfs(payloads[i*n:(i+1)*n], pytrends_dfs[i*n:(i+1)*n]))
                 for keyword in keywords_columns:
                     keyword_to_time_series[keyword] = keyword_to_time_series[keyword]+keyword_to_time_series_1[keyword]    
         df = pd.DataFrame(keyword_to_time_series)
         if scaled == True:
-            scaler = MinMaxScaler(feature_range=(0,100))
-            df_scaled = pd.DataFrame(scaler.fit_transform(df), columns=df.columns)
-            return df_scaled
+            return self._scale(df)
         else:
             return df
 
+    def _scale(self, df):
+        scaler = MinMaxScaler(feature_range=(0,100))
+        return pd.DataFrame(scaler.fit_transform(df), columns=df.columns, index=df.index)
+
+    def _get_monthly_data(self, start_month, end_month, times):
+        #unscaled get_data of the months start_month to end_month (pd.Period), indexed by month ('YYYY-MM')
+        df = self.get_data(times=times, date=f'{start_month.start_time:%Y-%m-%d} {end_month.end_time:%Y-%m-%d}', scaled=False)
+        months = pd.period_range(start_month, end_month, freq='M').strftime('%Y-%m')
+        if len(df) != len(months):
+            raise ValueError(f'Google Trends returned {len(df)} months for the {len(months)} months {months[0]} to {months[-1]}')
+        df.index = pd.Index(months, name='month')
+        return df
+
+    def update_data(self,trends_dir,times=1,overlap_months=3,end_month=None):
+        """Adds the months up to end_month (default: the last full month) to trends_dir/google_trends.csv (monthly
+        interest, unscaled) and trends_dir/google_trends_scaled.csv (the same scaled to 0-100 as get_data, with a month
+        column), fetching only the last overlap_months stored months and the new ones. The new months are put on the
+        scale of the stored ones by the ratio of their interest over the overlapping months (1, with a warning, for terms
+        without interest in the overlap on either side), then the whole history is scaled again. Without google_trends.csv, the months of google_trends_scaled.csv are fetched once to create it.
+        Returns the scaled data"""
+        raw_path = os.path.join(trends_dir, 'google_trends.csv')
+        scaled_path = os.path.join(trends_dir, 'google_trends_scaled.csv')
+        end_month = pd.Timestamp.today().to_period('M') - 1 if end_month is None else pd.Period(end_month, freq='M')
+
+        if os.path.exists(raw_path):
+            history = pd.read_csv(raw_path, index_col='month')
+            last_month = pd.Period(history.index.max(), freq='M')
+            if last_month < end_month:
+                new = self._get_monthly_data(last_month - (overlap_months - 1), end_month, times)
+                overlap = history.index.intersection(new.index)
+                ratio = history.loc[overlap].sum() / new.loc[overlap].sum()
+                #a zero overlap on either side gives no scale, and a NaN or 0 ratio would wipe the new months for good
+                unscaled = ratio.index[~np.isfinite(ratio) | (ratio <= 0)]
+                if len(unscaled) > 0:
+                    warnings.warn(f'no interest over the {overlap_months} overlapping months for {list(unscaled)}, '
+                                  'their new months are added unscaled (ratio 1); use a larger overlap_months to rescale them')
+                    ratio[unscaled] = 1.
+                history = pd.concat([history, new.loc[new.index > history.index.max()].mul(ratio)])
+        else:
+            first_month = pd.Period(pd.read_csv(scaled_path)['month'].min(), freq='M')
+            history = self._get_monthly_data(first_month, end_month, times)
+        history.to_csv(raw_path)
+
+        scaled = self._scale(history).reset_index()
+        scaled.to_csv(scaled_path)
+        return scaled
@@ -0,0 +1,94 @@
+import hashlib
+import pickle
+import pandas as pd
+from preprocessing import preprocessingMLS
+from models import BTSMEngine
+
+
+class incrementalForecast(object):
+    """Month-over-month refresh of the market-level forecast.
+
+    Holds the per-month totals of the listings (preprocessingMLS.month_totals), the feature
+    frame (featureEngineering) and one rollingCombinedModel per target, and persists them with
+    save(). A monthly update() then only:
+        - adds the list / sale events of the newly observed months to the monthly totals,
+        - appends the new months to the feature frame, computing only their lag / pct change /
+          one hot features,
+        - refits the horizon models warm-started from the persisted state: Lasso / Ridge reuse
+          last month's alphas and coefficients instead of cross validating again, for the full
+          window fits and their bootstrap refits alike, and BTSM starts from last month's
+          surrogate posterior.
+    The alphas are cross validated again (a cold fit) every revalidate_every months, and as soon
+    as the months the models were last validated on no longer have the same data.
+    """
+    def __init__(self, process, fe, models, start_date='2016-03', revalidate_every=12):
+        self.process = process
+        self.fe = fe
+        self.models = models #{target_column: rollingCombinedModel}
+        self.start_date = start_date
+        self.revalidate_every = revalidate_every
+        self.validated_months = None #months of the frame at the last cross validation, and their fingerprint
+        self.validated_fingerprint = None
+        for model in self.models.values():
+            model.warm_start = True
+            if getattr(model, 'engine', None) is None:
+                model.engine = BTSMEngine(warm_start_steps=100)
+
+    def update(self, new_listings, new_feature_rows, months=None):
+        """new_listings: listings (DataFrame or csv path) with list / sale events in the new months.
+        new_feature_rows: the other raw features (e.g. google trends) of the new months, with a month column."""
+        self.process.update(new_listings, months)
+        monthData = self.process.get_monthly_data(columns=['count_sale','count_list','sale_price'],
+                                                  start_date=self.start_date, end_date=self.process.monthData['month'].max())
+        new_rows = monthData[~monthData['month'].isin(self.fe.df['month'])]
+        new_rows = pd.merge(new_rows, new_feature_rows)
+        df = self.fe.append_rows(new_rows)
+        for model in self.models.values():
+            model.df = df
+        return list(new_rows['month'])
+
+    def get_fingerprint(self, months):
+        #hash of the frame rows of the months
+        df = self.fe.get_dataFrame()
+        rows = df[df['month'].isin(months)]
+        return hashlib.sha1(pd.util.hash_pandas_object(rows, index=False).values.tobytes()).hexdigest()
+
+    def needs_revalidation(self,):
+        if self.validated_months is None:
+            return True
+        months = self.fe.get_dataFrame()['month']
+        if (~months.isin(self.validated_months)).sum() >= self.revalidate_every:
+            return True
+        return self.get_fingerprint(self.validated_months) != self.validated_fingerprint
+
+    def make_prediction(self,):
+        df = self.fe.get_dataFrame()
+        feature_column_names = self.fe.get_feature_names()
+        revalidate = self.needs_revalidation()
+        if revalidate:
+            #without warm states, the full window fits cross validate the Lasso / Ridge alphas again
+            for model in self.models.values():
+                model.warm_states = {}
+        predictions = {target:model.make_prediction(df[feature_column_names], df[target])
+                       for target, model in self.models.items()}
+        if revalidate:
+            self.validated_months = list(df['month'])
+            self.validated_fingerprint = self.get_fingerprint(self.validated_months)
+        return predictions
+
+    def save(self, path):
+        #the raw listings are not persisted, only their monthly totals
+        with open(path, 'wb') as f:
+            pickle.dump({'month_totals':self.process.month_totals, 'fe':self.fe, 'models':self.models,
+                         'start_date':self.start_date, 'revalidate_every':self.revalidate_every,
+                         'validated_months':self.validated_months, 'validated_fingerprint':self.validated_fingerprint}, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+        forecast = cls(preprocessingMLS.from_month_totals(state['month_totals']), state['fe'], state['models'],
+                       start_date=state['start_date'], revalidate_every=state.get('revalidate_every', 12))
+        forecast.validated_months = state.get('validated_months')
+        forecast.validated_fingerprint = state.get('validated_fingerprint')
+        return forecast
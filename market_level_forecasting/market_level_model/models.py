@@ -1,3 +1,10 @@
+import copy
+import hashlib
+import multiprocessing
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
 import numpy as np
 import pandas as pd
 import sklearn
@@ -9,6 +16,7 @@ from sklearn.model_selection import train_test_split
 from sklearn.model_selection import cross_val_score
 from sklearn.metrics import mean_squared_error, r2_score
 from sklearn.decomposition import PCA
+from concurrent.futures import ProcessPoolExecutor
 import tensorflow.compat.v2 as tf
 from tensorflow_probability import sts
 import tensorflow_probability as tfp
@@ -48,13 +56,18 @@ class baseModel(object):
         else:
             return train_X, test_X, train_y, test_y
 
-    def select_features(self,x,y,method='Lasso'): #method: 'Lasso','PCA','Feature Importance'
+    def select_features(self,x,y,method='Lasso',warm_state=None): #method: 'Lasso','PCA','Feature Importance'
         if method == 'Lasso':
             lr = LassoCV()
             if self.lead_target == False:
                 lr = LassoCV()
+            if warm_state is not None:
+                #reuse last fit's alpha and start coordinate descent from its coefficients
+                lr = Lasso(alpha=warm_state['lasso_alpha'], warm_start=True)
+                lr.coef_ = warm_state['lasso_coef'].copy()
             #print(x.shape, y.shape)
             lr.fit(x, y)
+            self.lasso = lr
             #print(lr.coef_)
             self.selected_features = self.feature_column_names[abs(lr.coef_)>0]
             #print(self.selected_features)
@@ -86,20 +99,69 @@ class baseModel(object):
     def set_features_no(self,features_no):
         self.selected_features_no = features_no
 
+def batched_ridge_bootstrap(x, y, x_pred, sam_idx, alphas=(0.1, 1.0, 10.0)):
+    """Solve the ridge regressions (with unpenalized intercept) of all bootstrap resamples at once.
+
+    x is the (n, p) design matrix, y the (n,) target, x_pred the (m, p) rows to predict and
+    sam_idx the (B, n) bootstrap row indices. Each resample is solved in its dual form
+    w = Xc^T (Xc Xc^T + alpha I)^-1 yc from one batched eigendecomposition of the (B, n, n)
+    centered Gram matrices, which gives every alpha of the grid for free. The alpha of each
+    resample is picked by its leave-one-out error, as RidgeCV does. Returns (B, m) predictions.
+    """
+    x_sam = x[sam_idx] #(B, n, p)
+    y_sam = y[sam_idx] #(B, n)
+    x_mean = x_sam.mean(axis=1)
+    y_mean = y_sam.mean(axis=1)
+    x_c = x_sam - x_mean[:, None, :]
+    y_c = y_sam - y_mean[:, None]
+
+    gram = np.einsum('bip,bjp->bij', x_c, x_c)
+    eig_val, eig_vec = np.linalg.eigh(gram)
+    eig_val = np.maximum(eig_val, 0.)
+    qty = np.einsum('bji,bj->bi', eig_vec, y_c)
+    n = y_sam.shape[1]
+
+    best_loo = np.full(len(sam_idx), np.inf)
+    best_dual = np.zeros_like(y_c)
+    for alpha in alphas:
+        shrink = eig_val/(eig_val+alpha)
+        fitted = np.einsum('bij,bj->bi', eig_vec, shrink*qty)
+        hat_diag = np.einsum('bij,bj->bi', eig_vec**2, shrink) + 1./n
+        loo = np.mean(((y_c-fitted)/(1.-hat_diag))**2, axis=1)
+        dual = np.einsum('bij,bj->bi', eig_vec, qty/(eig_val+alpha))
+        better = loo < best_loo
+        best_loo[better] = loo[better]
+        best_dual[better] = dual[better]
+
+    coef = np.einsum('bip,bi->bp', x_c, best_dual)
+    return np.einsum('mp,bp->bm', x_pred, coef) - np.einsum('bp,bp->b', x_mean, coef)[:, None] + y_mean[:, None]
+
+
 class linearModel(baseModel): 
-    def fit(self,x,y,select_features= True, standardise=True): 
-    
-        if standardise == True:
+    def fit(self,x,y,select_features= True, standardise=True, warm_state=None, standardised=None): 
+        #standardised: (fitted StandardScaler, standardised x) of x, e.g. from windowCache
+        if standardised is not None:
+            self.std, x = standardised
+        elif standardise == True:
             x = self.standard(x)
         if select_features == True:
-            self.select_features(x,y)
+            self.select_features(x,y,warm_state=warm_state)
         #fit ridge models
         self.model =  RidgeCV()
+        if warm_state is not None:
+            self.model = RidgeCV(alphas=[warm_state['ridge_alpha']])
         if len(self.selected_features) == 0:
             self.model = None
         else:
             self.model.fit(x[:,self.selected_features_no],y)
 
+    def get_warm_state(self,):
+        #what the next fit on a slightly longer window needs to skip the Lasso / Ridge cross validation
+        if self.model == None or not hasattr(self, 'lasso'):
+            return None
+        lasso_alpha = self.lasso.alpha_ if hasattr(self.lasso, 'alpha_') else self.lasso.alpha
+        return {'lasso_alpha':lasso_alpha, 'lasso_coef':self.lasso.coef_.copy(), 'ridge_alpha':self.model.alpha_}
+
     def predict(self,x,standardise =True):
         if self.model == None:
             print('Questionable models: not informative features!')
@@ -114,6 +176,32 @@ class linearModel(baseModel):
         diff_predict = self.predict(x,standardise = standardise)
         return x[self.target_column]+diff_predict
 
+    def fit_bootstrap(self,x,y,x_pred,num_samples=50,fixed_alpha=False,alphas=(0.1, 1.0, 10.0),rng=None,batch_size=256,x_std=None):
+        """Fast bootstrap: predict x_pred from num_samples resampled ridge fits solved as one batch.
+
+        Reuses the standardisation and Lasso-selected features of the last self.fit(x,y) for all
+        resamples instead of refitting a StandardScaler, LassoCV and RidgeCV per resample. With
+        fixed_alpha=True every resample uses the alpha RidgeCV picked on the full window, otherwise
+        each resample picks its own alpha from the alphas grid. x_std is x already standardised by
+        the last fit (windowCache), to skip transforming it again. Returns (num_samples, len(x_pred)).
+
+        The scaler and the selected features are not resampled, so the spread of the samples leaves
+        out the feature selection uncertainty the serial bootstrap of rollingModel.fit_predict
+        includes: the intervals are much narrower (e.g. a std 4x smaller at horizon 1). That is why
+        rollingModel only uses it with fast_bootstrap=True.
+        """
+        rng = np.random if rng is None else rng
+        sam_idx = rng.choice(len(y), size=(num_samples, len(y)))
+        if self.model == None:
+            return np.zeros((num_samples, x_pred.shape[0]))
+        if fixed_alpha == True:
+            alphas = (self.model.alpha_,)
+        x = (self.std.transform(x) if x_std is None else x_std)[:,self.selected_features_no]
+        x_pred = self.std.transform(x_pred)[:,self.selected_features_no]
+        y = np.asarray(y, dtype=float)
+        return np.vstack([batched_ridge_bootstrap(x, y, x_pred, sam_idx[b:b+batch_size], alphas)
+                          for b in range(0, num_samples, batch_size)])
+
 class TreeModel(baseModel):
     def fit(self,x,y,select_features= True): 
         if select_features == True:
@@ -138,9 +226,9 @@ class TreeModel(baseModel):
         diff_predict = self.predict(x)
         return x[self.target_column]+diff_predict   
 
-def build_model(observed_time_series):
+def build_model(observed_time_series, num_seasons=12):
     trend = sts.LocalLinearTrend(observed_time_series=observed_time_series)
-    seasonal = tfp.sts.Seasonal(num_seasons=12, observed_time_series=observed_time_series)
+    seasonal = tfp.sts.Seasonal(num_seasons=num_seasons, observed_time_series=observed_time_series)
     all_components = [trend,seasonal]
 
     model = sts.Sum(all_components, observed_time_series=observed_time_series)
@@ -179,19 +267,178 @@ def build_variational_posteriors(model, training_data, nsamples,
     return q_samples
 
 
+class BTSMEngine(object):
+    """Compile-once training and forecasting for BTSM.
+
+    The series are standardised before fitting, so the model priors and the surrogate
+    posterior bijectors (which scale with the empirical std of the series) are the same
+    for every series. That lets the model be built inside the compiled functions from the
+    series passed in as an argument, and the train / forecast functions are cached by
+    (series length, component spec) instead of being retraced and XLA-recompiled per fit.
+
+    There is one surrogate posterior per component spec. Its parameters do not depend on
+    the series length, so each fit warm-starts from the previous fit (e.g. the previous
+    rolling window) and can use fewer steps (warm_start_steps).
+
+    With pad_to set, series are front-padded with masked values up to a multiple of pad_to,
+    so the growing windows of a rolling backtest share one compiled graph per bucket. The
+    number of posterior samples (nsamples, default the padded length) is part of the forecast
+    graph's input shape, so it is the same for all the windows of a bucket as well.
+
+    fit() also takes a (series x time) array: the model then has batch shape [series] and a
+    single vectorized surrogate posterior is optimized for all series at once (see batchBTSM).
+    """
+    def __init__(self, num_seasons=12, num_variational_steps=200, warm_start_steps=None, learning_rate=.1, warm_start=True,
+                 pad_to=None, nsamples=None):
+        self.num_seasons = num_seasons
+        self.pad_to = pad_to
+        self.nsamples = nsamples
+        self.num_variational_steps = num_variational_steps
+        self.warm_start_steps = num_variational_steps if warm_start_steps is None else warm_start_steps
+        self.learning_rate = learning_rate
+        self.warm_start = warm_start
+        self.spec = ('LocalLinearTrend', ('Seasonal', num_seasons))
+        self.surrogate_posteriors = {}
+        self.optimizers = {}
+        self.train_fns = {}
+        self.forecast_fns = {}
+        self.warm_start_weights = {}
+
+    def __getstate__(self):
+        #compiled functions and tf variables are not picklable: a pickled copy (persisted state,
+        #or a copy sent to a worker process) keeps the configuration and the surrogate posterior
+        #parameters, and rebuilds its caches, warm-started from those parameters, on first fit
+        state = self.__dict__.copy()
+        state['warm_start_weights'] = dict(self.warm_start_weights)
+        state['warm_start_weights'].update(self.get_weights())
+        for cache in ['surrogate_posteriors', 'optimizers', 'train_fns', 'forecast_fns']:
+            state[cache] = {}
+        return state
+
+    def get_weights(self,):
+        return {key:[variable.numpy() for variable in surrogate_posterior.trainable_variables]
+                for key, surrogate_posterior in self.surrogate_posteriors.items()}
+
+    def standardise(self, observed_time_series):
+        observed_time_series = np.asarray(observed_time_series, dtype=float)
+        loc = observed_time_series.mean(axis=-1, keepdims=True)
+        scale = observed_time_series.std(axis=-1, keepdims=True)
+        scale[scale == 0] = 1.
+        return (observed_time_series-loc)/scale, loc, scale
+
+    def pad(self, observed_time_series):
+        num_pad = 0 if self.pad_to is None else -observed_time_series.shape[-1] % self.pad_to
+        pad_width = [(0, 0)]*(observed_time_series.ndim-1) + [(num_pad, 0)]
+        is_missing = np.pad(np.zeros(observed_time_series.shape, dtype=bool), pad_width, constant_values=True)
+        return np.pad(observed_time_series, pad_width), is_missing
+
+    def get_surrogate_posterior(self, observed_time_series, batch_shape=()):
+        key = (self.spec, batch_shape)
+        if key not in self.surrogate_posteriors or self.warm_start == False:
+            model = build_model(observed_time_series, num_seasons=self.num_seasons)
+            self.surrogate_posteriors[key] = tfp.sts.build_factored_surrogate_posterior(model=model)
+            self.optimizers[key] = tf.optimizers.Adam(learning_rate=self.learning_rate)
+            self.train_fns = {train_key:fn for train_key, fn in self.train_fns.items()
+                              if (train_key[1], train_key[0][:-1]) != key}
+            if key in self.warm_start_weights and self.warm_start == True:
+                for variable, value in zip(self.surrogate_posteriors[key].trainable_variables, self.warm_start_weights.pop(key)):
+                    variable.assign(value)
+                return self.surrogate_posteriors[key], True
+            return self.surrogate_posteriors[key], False
+        return self.surrogate_posteriors[key], True
+
+    def get_train_fn(self, shape, num_steps):
+        key = (shape, self.spec, num_steps)
+        if key not in self.train_fns:
+            surrogate_posterior = self.surrogate_posteriors[(self.spec, shape[:-1])]
+            optimizer = self.optimizers[(self.spec, shape[:-1])]
+            num_seasons = self.num_seasons
+
+            @tf.function(experimental_compile=True)
+            def train(observed_time_series, is_missing):
+                observed_time_series = tfp.sts.MaskedTimeSeries(observed_time_series, is_missing)
+                model = build_model(observed_time_series, num_seasons=num_seasons)
+                elbo_loss_curve = tfp.vi.fit_surrogate_posterior(
+                target_log_prob_fn=model.joint_log_prob(observed_time_series=observed_time_series),
+                surrogate_posterior=surrogate_posterior,
+                optimizer=optimizer,
+                num_steps=num_steps)
+                return elbo_loss_curve
+            self.train_fns[key] = train
+        return self.train_fns[key]
+
+    def get_forecast_fn(self, shape, nsamples, num_steps_forecast, num_samples):
+        key = (shape, self.spec, nsamples, num_steps_forecast, num_samples)
+        if key not in self.forecast_fns:
+            num_seasons = self.num_seasons
+
+            @tf.function
+            def forecast(observed_time_series, is_missing, parameter_samples):
+                observed_time_series = tfp.sts.MaskedTimeSeries(observed_time_series, is_missing)
+                model = build_model(observed_time_series, num_seasons=num_seasons)
+                forecast_dist = tfp.sts.forecast(model, observed_time_series=observed_time_series,
+                                                 parameter_samples=parameter_samples, num_steps_forecast=num_steps_forecast)
+                return (forecast_dist.mean()[..., 0], forecast_dist.stddev()[..., 0],
+                        forecast_dist.sample(num_samples)[..., 0])
+            self.forecast_fns[key] = forecast
+        return self.forecast_fns[key]
+
+    def fit(self, observed_time_series, nsamples=None):
+        """Fit the surrogate posterior to the series (time,) or (series x time) and draw nsamples
+        (default: self.nsamples, or the number of time steps after padding) parameter samples
+        from it. Returns the state that forecast() needs."""
+        observed_std, loc, scale = self.standardise(observed_time_series)
+        observed_std, is_missing = self.pad(observed_std)
+        shape = observed_std.shape
+        observed_std, is_missing = tf.convert_to_tensor(observed_std), tf.convert_to_tensor(is_missing)
+        surrogate_posterior, warm = self.get_surrogate_posterior(tfp.sts.MaskedTimeSeries(observed_std, is_missing),
+                                                                 batch_shape=shape[:-1])
+        num_steps = self.warm_start_steps if warm else self.num_variational_steps
+        elbo_loss_curve = self.get_train_fn(shape, num_steps)(observed_std, is_missing)
+        if nsamples is None:
+            nsamples = shape[-1] if getattr(self, 'nsamples', None) is None else self.nsamples
+        q_samples = surrogate_posterior.sample(nsamples)
+        return {'observed_time_series':observed_std, 'is_missing':is_missing, 'loc':loc, 'scale':scale,
+                'q_samples':q_samples, 'nsamples':nsamples, 'elbo_loss_curve':elbo_loss_curve}
+
+    def forecast(self, state, num_steps_forecast, num_samples=50):
+        """Returns forecast mean and scale (..., num_steps_forecast) and samples
+        (num_samples, ..., num_steps_forecast), where ... is the series batch shape."""
+        forecast = self.get_forecast_fn(tuple(state['observed_time_series'].shape), state['nsamples'], num_steps_forecast, num_samples)
+        forecast_mean, forecast_scale, forecast_samples = forecast(state['observed_time_series'], state['is_missing'],
+                                                                   state['q_samples'])
+        return (forecast_mean.numpy()*state['scale']+state['loc'],
+                forecast_scale.numpy()*state['scale'],
+                forecast_samples.numpy()*state['scale']+state['loc'])
+
+
 class BTSM(object):
-    def __init__(self,):
+    def __init__(self, engine=None):
         self.model = 0
         self.q_samples = 0
+        self.engine = engine #BTSMEngine shared across fits, None builds and compiles the model on every fit
+
+    def __getstate__(self):
+        #the fitted tfp model and posterior samples are not persisted, only the engine (if any)
+        state = self.__dict__.copy()
+        for attr in ['model', 'q_samples', 'engine_state']:
+            if attr in state:
+                state[attr] = 0
+        return state
         
     def fit(self,x_train, y_train):
         self.train = x_train
+        if getattr(self, 'engine', None) is not None:
+            self.engine_state = self.engine.fit(x_train)
+            return
         self.model = build_model(x_train)
         self.q_samples = build_variational_posteriors(self.model, x_train,len(x_train),
                                                 optimizer = tf.optimizers.Adam(learning_rate=.1),
                                                 plot = False)
            
     def predict(self,x_test,num_samples=50):
+        if getattr(self, 'engine', None) is not None:
+            return self.engine.forecast(self.engine_state, len(x_test), num_samples)
         forecast_dist = tfp.sts.forecast(self.model, observed_time_series=self.train,
                                             parameter_samples=self.q_samples, num_steps_forecast=len(x_test))
 
@@ -201,8 +448,210 @@ class BTSM(object):
         return forecast_mean, forecast_scale, forecast_samples
         
 
+class batchBTSM(object):
+    """Fit one BTSM over several series at once, e.g. count_sale and count_list of several
+    market areas, with a single vectorized variational optimization.
+
+    x_train is a (series x time) array, or a DataFrame with one column per series (its column
+    names are then used as keys of the forecasts). The series must share the same months.
+    """
+    def __init__(self, engine=None):
+        self.engine = engine if engine is not None else BTSMEngine()
+        self.series_names = None
+
+    def fit(self, x_train, y_train=None):
+        if isinstance(x_train, pd.DataFrame):
+            self.series_names = list(x_train.columns)
+            x_train = x_train.values.T
+        self.train = np.asarray(x_train, dtype=float)
+        self.engine_state = self.engine.fit(self.train)
+
+    def predict(self, x_test, num_samples=50):
+        """Returns the per-series forecast_mean, forecast_scale (series x len(x_test)) and
+        forecast_samples (series x num_samples x len(x_test))."""
+        forecast_mean, forecast_scale, forecast_samples = self.engine.forecast(self.engine_state, len(x_test), num_samples)
+        return forecast_mean, forecast_scale, np.moveaxis(forecast_samples, 0, 1)
+
+    def predict_series(self, x_test, num_samples=50):
+        """Same as predict, as a dict of (forecast_mean, forecast_scale, forecast_samples) per series."""
+        forecast_mean, forecast_scale, forecast_samples = self.predict(x_test, num_samples)
+        series_names = self.series_names if self.series_names is not None else range(len(forecast_mean))
+        return {name:(forecast_mean[k], forecast_scale[k], forecast_samples[k]) for k, name in enumerate(series_names)}
+
+
+#(x, y, x_pred) of the horizons, loaded once per worker process by _load_horizon
+_horizon_data = OrderedDict()
+
+def _load_horizon(path, max_horizons=8):
+    if path not in _horizon_data:
+        _horizon_data[path] = pd.read_pickle(path)
+        while len(_horizon_data) > max_horizons:
+            _horizon_data.popitem(last=False)
+    return _horizon_data[path]
+
+def _bootstrap_task(model, path, y_last, lead_target, seeds, warm_state=None):
+    #refit a copy of the horizon model on one bootstrap resample per seed (runs in a worker process),
+    #the horizon data being read from path the first time a worker gets one of its chunks.
+    #warm_state: see rollingModel.get_resample_warm_state
+    x, y, x_pred = _load_horizon(path)
+    pred_samples = []
+    for seed in seeds:
+        rng = np.random.default_rng(seed)
+        sam_idx = rng.integers(0, len(y), size=len(y))
+        if warm_state is not None:
+            model.fit(x.iloc[sam_idx,:], y.iloc[sam_idx], warm_state=warm_state)
+        else:
+            model.fit(x.iloc[sam_idx,:], y.iloc[sam_idx])
+        pred_diff = model.predict(x_pred)
+        if lead_target == True:
+            pred_samples.append(pred_diff[-1]+y_last)
+        else:
+            pred_samples.append(pred_diff[-1])
+    return pred_samples
+
+
+class bootstrapExecutor(object):
+    """Run the bootstrap refits of rollingModel.fit_predict on a process pool.
+
+    Every (horizon, sample) fit gets its own np.random.Generator seeded from a
+    SeedSequence spawned off random_state, so the samples are reproducible and do
+    not depend on n_jobs or chunk_size. Fits are sent to the workers in chunks of
+    chunk_size samples, with a copy of the horizon model without its df; the design
+    matrix and target of each horizon are written once to a temporary file that each
+    worker reads once.
+    The workers are spawned, not forked (tensorflow is not fork-safe), so the pool is
+    created on the first run and kept for the next ones: close() it when done, or use
+    the executor as a context manager. It can not be combined with rollingModel's
+    fast_bootstrap.
+    """
+    def __init__(self, n_jobs=None, random_state=None, chunk_size=10):
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+        self.chunk_size = chunk_size
+        self.pool = None
+        self.tmp_dir = None
+        self.n_runs = 0
+
+    def __getstate__(self):
+        #the pool is not picklable: a copy (e.g. of a pickled rollingModel) starts its own
+        state = self.__dict__.copy()
+        state['pool'] = None
+        state['tmp_dir'] = None
+        return state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get_pool(self):
+        if self.pool is None:
+            #spawn rather than fork: tensorflow is not fork-safe once initialized
+            self.pool = ProcessPoolExecutor(max_workers=self.n_jobs, mp_context=multiprocessing.get_context('spawn'))
+            self.tmp_dir = tempfile.mkdtemp(prefix='bootstrap_')
+        return self.pool
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        self.pool = None
+        self.tmp_dir = None
+
+    def get_seeds(self, predict_horizon, num_samples):
+        seed_seq = np.random.SeedSequence(self.random_state)
+        return np.array(seed_seq.spawn(predict_horizon*num_samples), dtype=object).reshape(predict_horizon, num_samples)
+
+    def run(self, rolling_model, x_train, y_train, start_fit=3, num_samples=50):
+        seeds = self.get_seeds(rolling_model.predict_horizon, num_samples)
+        x_pred = x_train[-start_fit:]
+        y_last = y_train.iloc[-1]
+        preds = []
+        futures = {}
+        paths = []
+        pool = self.get_pool()
+        self.n_runs += 1
+        try:
+            for i in range(1,rolling_model.predict_horizon+1):
+                horizon = rolling_model._get_horizon(x_train, y_train, i, start_fit)
+                x, y = rolling_model.get_horizon_data(x_train, y_train, i, start_fit)
+                model = rolling_model.models[i]
+                #the point prediction is fitted on the full window in this process, so self.models stay fitted
+                rolling_model.fit_horizon(i, x, y, horizon)
+                pred_diff = model.predict(x_pred)
+                if rolling_model.lead_target == True:
+                    preds.append(pred_diff[-1]+y_last)
+                else:
+                    preds.append(pred_diff[-1])
+                path = os.path.join(self.tmp_dir, f'run{self.n_runs}_horizon{i}.pkl')
+                pd.to_pickle((x, y, x_pred), path)
+                paths.append(path)
+                task_model = copy.copy(model)
+                task_model.df = None
+                futures[i] = [pool.submit(_bootstrap_task, task_model, path, y_last, rolling_model.lead_target,
+                                          seeds[i-1, sam:sam+self.chunk_size], rolling_model.get_resample_warm_state(i))
+                              for sam in range(0, num_samples, self.chunk_size)]
+            total_pred_samples = [[pred for future in futures[i] for pred in future.result()]
+                                  for i in range(1,rolling_model.predict_horizon+1)]
+        finally:
+            for path in paths:
+                os.remove(path)
+        total_pred_samples = np.array(total_pred_samples)
+        return preds, total_pred_samples.mean(axis=1), total_pred_samples.std(axis=1), total_pred_samples.T
+
+
+class windowCache(object):
+    """Horizon data and full window fits of the training windows of rollingModel, memoized by window.
+
+    The windows are keyed by the hash of their features and target, so fit, fit_predict, the
+    bootstrap executor and the second fit of each window by rollingCombinedModel all share them.
+    For each horizon i of a window, it keeps the design matrix x_train[start_fit:-i] (a view of
+    the window), the shifted target, the StandardScaler fitted on it with the standardised matrix,
+    and the state of the horizon model after its full window fit, so refitting the same window and
+    horizon is a lookup. The max_windows most recently used windows are kept, and none are pickled.
+    """
+    def __init__(self, max_windows=4):
+        self.max_windows = max_windows
+        self.windows = OrderedDict()
+
+    def __getstate__(self):
+        return {'max_windows':self.max_windows, 'windows':OrderedDict()}
+
+    def get_window(self, x_train, y_train, start_fit, lead_target):
+        key = hashlib.sha1()
+        key.update(repr((list(x_train.columns), x_train.shape, start_fit, lead_target)).encode())
+        key.update(np.ascontiguousarray(x_train.to_numpy(dtype=float)).tobytes())
+        key.update(np.ascontiguousarray(np.asarray(y_train, dtype=float)).tobytes())
+        key = key.hexdigest()
+        if key not in self.windows:
+            self.windows[key] = {'x_train':x_train, 'y_train':y_train, 'start_fit':start_fit,
+                                 'lead_target':lead_target, 'horizons':{}}
+            while len(self.windows) > self.max_windows:
+                self.windows.popitem(last=False)
+        self.windows.move_to_end(key)
+        return self.windows[key]
+
+    def get_horizon(self, x_train, y_train, i, start_fit=3, lead_target=True):
+        window = self.get_window(x_train, y_train, start_fit, lead_target)
+        if i not in window['horizons']:
+            if lead_target == True:
+                y = y_train.diff(i).shift(-i)[start_fit:-i]
+            else:
+                y = y_train.shift(-i)[start_fit:-i]
+            window['horizons'][i] = {'x':x_train[start_fit:-i], 'y':y, 'standardised':None, 'fits':{}}
+        return window['horizons'][i]
+
+    def get_standardised(self, horizon):
+        if horizon['standardised'] is None:
+            std = StandardScaler()
+            horizon['standardised'] = (std, std.fit_transform(horizon['x']))
+        return horizon['standardised']
+
+
 class rollingModel(object):
-    def __init__(self,df, predict_horizon,target_column,feature_column_names,modelName='linear',lead_target=True):
+    def __init__(self,df, predict_horizon,target_column,feature_column_names,modelName='linear',lead_target=True,
+                 executor=None, fast_bootstrap=False, cache=True, reuse_horizon_alphas=False):
         self.models = {}
         if modelName == 'linear':
             for i in range(1,predict_horizon+1): 
@@ -216,6 +665,18 @@ class rollingModel(object):
         self.target_column= target_column
         self.feature_column_names = feature_column_names
         self.lead_target = lead_target
+        self.executor = executor #bootstrapExecutor, None runs the bootstrap serially
+        #solve the linear bootstrap as one batch (linearModel.fit_bootstrap), exclusive with executor.
+        #Off by default: it keeps the features fixed across resamples, which gives narrower intervals
+        self.fast_bootstrap = fast_bootstrap
+        self.warm_start = False #warm-start the full window fits from self.warm_states (incremental updates)
+        self.warm_states = {}
+        self.cache = windowCache() if cache == True else None #memoized horizon data and fits of the windows
+        #fit the Lasso / Ridge of horizon i+1 with the alphas of horizon i (from its coefficients) instead of
+        #cross validating them. Off by default: the alphas of each horizon then differ from a cold fit, and so
+        #do the predictions; the default fit cross validates every horizon
+        self.reuse_horizon_alphas = reuse_horizon_alphas
+        self.horizon_states = {}
 
     def model_split(self,x, y, time_cv, return_idx = False, cv=None): #cv is the k-fold number
         time_periods = len(x)
@@ -238,20 +699,70 @@ class rollingModel(object):
         else:
             return self.groups_train, self.groups_test, self.split_idx
 
+    def _get_horizon(self, x_train, y_train, i, start_fit=3):
+        #memoized horizon data of the window, None without a cache
+        cache = getattr(self, 'cache', None)
+        if cache is None:
+            return None
+        return cache.get_horizon(x_train, y_train, i, start_fit, self.lead_target)
+
+    def get_horizon_data(self, x_train, y_train, i, start_fit=3):
+        horizon = self._get_horizon(x_train, y_train, i, start_fit)
+        if horizon is not None:
+            return horizon['x'], horizon['y']
+        if self.lead_target == True:
+            y = y_train.diff(i).shift(-i)[start_fit:-i]
+        else:
+            y = y_train.shift(-i)[start_fit:-i]
+        x = x_train[start_fit:-i]
+        return x, y
+
+    def fit_horizon(self, i, x, y, horizon=None):
+        #full window fit of horizon i, warm-started from the previous fit when self.warm_start is set,
+        #or with the alphas of the fit of horizon i-1 when self.reuse_horizon_alphas is set.
+        #horizon: the windowCache entry of x, y, whose standardisation and earlier fit are reused
+        model = self.models[i]
+        is_linear = isinstance(model, linearModel)
+        if not hasattr(self, 'horizon_states'):
+            self.horizon_states = {}
+        if getattr(self, 'warm_start', False) == True and is_linear:
+            model.fit(x,y,warm_state=self.warm_states.get(i),
+                      standardised=None if horizon is None else self.cache.get_standardised(horizon))
+            self.warm_states[i] = model.get_warm_state()
+            return
+        reuse_horizon_alphas = getattr(self, 'reuse_horizon_alphas', False) == True and is_linear
+        if horizon is not None and reuse_horizon_alphas in horizon['fits']:
+            #same window, horizon and alpha mode: restore the earlier fit
+            model.__dict__.update(horizon['fits'][reuse_horizon_alphas])
+        elif is_linear:
+            warm_state = self.horizon_states.get(i-1) if reuse_horizon_alphas else None
+            model.fit(x,y,warm_state=warm_state,
+                      standardised=None if horizon is None else self.cache.get_standardised(horizon))
+        else:
+            model.fit(x,y)
+        if horizon is not None:
+            horizon['fits'][reuse_horizon_alphas] = {k:v for k, v in model.__dict__.items() if k != 'df'}
+        if is_linear:
+            self.horizon_states[i] = model.get_warm_state()
+
+    def get_resample_warm_state(self, i):
+        #with self.warm_start, the bootstrap refits of horizon i reuse the alphas of its full window fit
+        #(and start from its coefficients) instead of cross validating the Lasso / Ridge of every resample
+        if getattr(self, 'warm_start', False) == True and isinstance(self.models[i], linearModel):
+            return self.warm_states.get(i)
+        return None
+
     def fit(self,x_train, y_train, start_fit=3):
         self.start_fit = start_fit
         #print('horizon', self.predict_horizon)
+        self.x_train = x_train
+        self.y_train = y_train
         for i in range(1,self.predict_horizon+1):
             #print('prediction_horizon', i)
-            self.x_train = x_train
-            self.y_train = y_train
-            if self.lead_target == True:
-                y = y_train.diff(i).shift(-i)[start_fit:-i]
-            else:
-                y = y_train.shift(-i)[start_fit:-i]
-            x = x_train[start_fit:-i]
+            horizon = self._get_horizon(x_train, y_train, i, start_fit)
+            x, y = self.get_horizon_data(x_train, y_train, i, start_fit)
             #print(self.models[i])
-            self.models[i].fit(x,y)
+            self.fit_horizon(i,x,y,horizon)
 
     def predict(self,):
         y_pred = []
@@ -263,8 +774,16 @@ class rollingModel(object):
                 y_pred.append(pred_diff[-1])
         return y_pred
     
-    def fit_predict(self, x_train, y_train, start_fit=3, num_samples=50):
+    def fit_predict(self, x_train, y_train, start_fit=3, num_samples=50, executor=None, fast_bootstrap=None):
         self.start_fit = start_fit
+        self.x_train = x_train
+        self.y_train = y_train
+        executor = executor if executor is not None else getattr(self, 'executor', None)
+        fast_bootstrap = fast_bootstrap if fast_bootstrap is not None else getattr(self, 'fast_bootstrap', False)
+        if executor is not None and fast_bootstrap == True:
+            raise ValueError('executor and fast_bootstrap are exclusive: the fast bootstrap runs in this process')
+        if executor is not None:
+            return executor.run(self, x_train, y_train, start_fit=start_fit, num_samples=num_samples)
         #print('horizon', self.predict_horizon)
         total_pred_scale = []
         total_pred_samples = []
@@ -274,12 +793,9 @@ class rollingModel(object):
             print('prediction_horizon', i)
             self.x_train = x_train
             self.y_train = y_train
-            if self.lead_target == True:
-                y = y_train.diff(i).shift(-i)[start_fit:-i]
-            else:
-                y = y_train.shift(-i)[start_fit:-i]
-            x = x_train[start_fit:-i]
-            self.models[i].fit(x,y)
+            horizon = self._get_horizon(x_train, y_train, i, start_fit)
+            x, y = self.get_horizon_data(x_train, y_train, i, start_fit)
+            self.fit_horizon(i,x,y,horizon)
             pred_diff = self.models[i].predict(self.x_train[-self.start_fit:])
             if self.lead_target == True:
                 preds.append(pred_diff[-1]+self.y_train.iloc[-1])
@@ -287,12 +803,23 @@ class rollingModel(object):
                 preds.append(pred_diff[-1])
             #print(self.models[i])
             pred_samples = []
-            for sam in range(num_samples):
+            if fast_bootstrap == True and isinstance(self.models[i], linearModel):
+                x_std = None if horizon is None else self.cache.get_standardised(horizon)[1]
+                pred_diff = self.models[i].fit_bootstrap(x,y,self.x_train[-self.start_fit:],num_samples,x_std=x_std)[:,-1]
+                if self.lead_target == True:
+                    pred_samples = list(pred_diff+self.y_train.iloc[-1])
+                else:
+                    pred_samples = list(pred_diff)
+            warm_state = self.get_resample_warm_state(i)
+            for sam in range(num_samples - len(pred_samples)):
                 sam_idx = np.random.choice(np.arange(len(y)),size=len(y))
                 x_sam = x.iloc[sam_idx,:]
                 y_sam = y.iloc[sam_idx]
                 #print(x_sam, y_sam)
-                self.models[i].fit(x_sam,y_sam)
+                if warm_state is not None:
+                    self.models[i].fit(x_sam,y_sam,warm_state=warm_state)
+                else:
+                    self.models[i].fit(x_sam,y_sam)
                 pred_diff = self.models[i].predict(self.x_train[-self.start_fit:])
                 if self.lead_target == True:
                     pred_samples.append(pred_diff[-1]+self.y_train.iloc[-1])
@@ -303,8 +830,16 @@ class rollingModel(object):
             total_pred_samples.append(pred_samples)
         return preds, np.array(total_pred_mean), np.array(total_pred_scale), np.array(total_pred_samples).T  
 
+    def get_windows(self,):
+        return self.model_split(self.df[self.feature_column_names],self.df[self.target_column],time_cv=self.predict_horizon,return_idx=False)
+
+    def predict_window(self, x, y):
+        #fit on one training window and forecast the next predict_horizon months: (pred, scale, samples)
+        pred_ahead, pred_mean, pred_std, pred_samples = self.fit_predict(x,y)
+        return pred_ahead, pred_std, pred_samples
+
     def rolling_prediction(self,start_predict_group,end_predict_group,time_cv,bootstrap=False):
-        groups_train, groups_test= self.model_split(self.df[self.feature_column_names],self.df[self.target_column],time_cv=self.predict_horizon,return_idx=False)
+        groups_train, groups_test= self.get_windows()
         pred_ahead_store = []
         pred_std_store = []
         #pred_ahead_score = []
@@ -312,7 +847,7 @@ class rollingModel(object):
             #print('start group', i)
             x = groups_train[i][0]
             y = groups_train[i][1]
-            pred_ahead, pred_mean, pred_std, pred_samples = self.fit_predict(x,y)
+            pred_ahead, pred_std, pred_samples = self.predict_window(x,y)
             #true_predict_length = len(groups_test[i][1])
             #score = mean_squared_error(groups_test[i][1],pred_ahead[:true_predict_length])
             pred_ahead_store.extend(pred_ahead)
@@ -322,23 +857,28 @@ class rollingModel(object):
 
 
 class rollingTimeSeriesModel(BTSM,rollingModel):
-    def __init__(self,df, predict_horizon,target_column):
+    def __init__(self,df, predict_horizon,target_column, engine=None):
+        BTSM.__init__(self, engine)
         self.df = df
         self.predict_horizon = predict_horizon
         self.target_column = target_column
     
+    def get_windows(self,):
+        return rollingModel.model_split(self,self.df[self.target_column],self.df[self.target_column],time_cv=self.predict_horizon,return_idx=False)
+
+    def predict_window(self, x, y):
+        BTSM.fit(self,x.values.astype(float),y.values.astype(float))
+        return BTSM.predict(self,np.ones(self.predict_horizon))
+
     def rolling_prediction(self,start_predict_group,end_predict_group):
-        groups_train, groups_test= rollingModel.model_split(self,self.df[self.target_column],self.df[self.target_column],time_cv=self.predict_horizon,return_idx=False)
+        groups_train, groups_test= self.get_windows()
         pred_ahead_store = []
         pred_ahead_score = []
         pred_ahead_scale = []
         for i in range(start_predict_group,end_predict_group):
-            x = groups_train[i][0].values.astype(float)
-            y = groups_train[i][1].values.astype(float)
             #print('x',x)
             #print('y',y)
-            BTSM.fit(self,x,y)
-            pred_ahead, pred_scale, pred_samples = BTSM.predict(self,np.ones(self.predict_horizon))
+            pred_ahead, pred_scale, pred_samples = self.predict_window(groups_train[i][0],groups_train[i][1])
             true_predict_length = len(groups_test[i][1])
             score = mean_squared_error(groups_test[i][1],pred_ahead[:true_predict_length])
             pred_ahead_store.extend(pred_ahead)
@@ -348,40 +888,48 @@ class rollingTimeSeriesModel(BTSM,rollingModel):
 
 
 class rollingCombinedModel(BTSM, rollingModel):
-    def __init__(self,df,predict_horizon_total, predict_horizon, feature_column_names, target_column,modelName='linear', lead_target=True, params=[0.5,0.5]):
-        rollingModel.__init__(self,df,predict_horizon, target_column, feature_column_names, modelName,lead_target)
-        BTSM.__init__(self,)
+    def __init__(self,df,predict_horizon_total, predict_horizon, feature_column_names, target_column,modelName='linear', lead_target=True, params=[0.5,0.5], executor=None, fast_bootstrap=False, engine=None):
+        rollingModel.__init__(self,df,predict_horizon, target_column, feature_column_names, modelName,lead_target, executor, fast_bootstrap)
+        BTSM.__init__(self, engine)
         self.df = df
         self.predict_horizon_total = predict_horizon_total
         self.predict_horizon = predict_horizon
         self.target_column = target_column
         self.feature_column_names = feature_column_names
         self.params = params
+    def get_windows(self,):
+        return rollingModel.model_split(self,self.df[self.feature_column_names],self.df[self.target_column],time_cv=self.predict_horizon_total,return_idx=False)
+
+    def predict_window(self, x, y):
+        #print(x)
+        rollingModel.fit(self,x,y)
+        #print('fit good!')
+        pred, pred_1, pred1_scale, pred1_samples = rollingModel.fit_predict(self,x,y)
+        BTSM.fit(self,y.values.astype(float),0)
+        pred_ts, pred_scale_ts, pred_samples_ts = BTSM.predict(self,np.ones(self.predict_horizon))
+        pred_com = self.params[0]*np.array(pred_1)+self.params[1]*pred_ts
+        pred_com_scale = self.params[0]*pred1_scale+self.params[1]*pred_scale_ts
+        #keep the unblended first stage so that other params can be scored without refitting
+        self.window_components = {'pred_linear':np.array(pred_1), 'scale_linear':np.array(pred1_scale),
+                                  'pred_ts':np.array(pred_ts), 'scale_ts':np.array(pred_scale_ts)}
+        #print('predict good!')
+        x = np.append(y.values.astype(float), pred_com)
+        BTSM.fit(self,x,0)
+        pred_2, pred2_scale, pred2_samples = BTSM.predict(self,np.ones(self.predict_horizon_total-self.predict_horizon))
+        #print('ts shape.', np.array(pred2_samples).shape)
+        #print('1 shape', np.array(pred1_samples).shape)
+        return np.append(pred_com, pred_2), np.append(pred_com_scale, pred2_scale), np.hstack((pred1_samples, pred2_samples))
+
     def rolling_prediction(self,start_predict_group, end_predict_group):
-        groups_train, groups_test = rollingModel.model_split(self,self.df[self.feature_column_names],self.df[self.target_column],time_cv=self.predict_horizon_total,return_idx=False)
+        groups_train, groups_test = self.get_windows()
         pred_ahead_store = []
         pred_samples_store = []
         pred_scale_store = []
         for i in range(start_predict_group,end_predict_group):
-            x = groups_train[i][0]
-            y = groups_train[i][1]
-            #print(x)
-            rollingModel.fit(self,x,y)
-            #print('fit good!')
-            pred, pred_1, pred1_scale, pred1_samples = rollingModel.fit_predict(self,x,y)
-            BTSM.fit(self,y.values.astype(float),0)
-            pred_ts, pred_scale_ts, pred_samples_ts = BTSM.predict(self,np.ones(self.predict_horizon))
-            pred_com = self.params[0]*np.array(pred_1)+self.params[1]*pred_ts
-            pred_com_scale = self.params[0]*pred1_scale+self.params[1]*pred_scale_ts
-            #print('predict good!')
-            x = np.append(groups_train[i][1].values.astype(float), pred_com)
-            BTSM.fit(self,x,0)
-            pred_2, pred2_scale, pred2_samples = BTSM.predict(self,np.ones(self.predict_horizon_total-self.predict_horizon))
-            pred_ahead_store.extend(np.append(pred_com, pred_2))
-            #print('ts shape.', np.array(pred2_samples).shape)
-            #print('1 shape', np.array(pred1_samples).shape)
-            pred_samples_store.extend(np.hstack((pred1_samples, pred2_samples)))
-            pred_scale_store.extend(np.append(pred_com_scale, pred2_scale))
+            pred_ahead, pred_scale, pred_samples = self.predict_window(groups_train[i][0],groups_train[i][1])
+            pred_ahead_store.extend(pred_ahead)
+            pred_samples_store.extend(pred_samples)
+            pred_scale_store.extend(pred_scale)
             print(i)
         return pred_ahead_store, pred_scale_store, pred_samples_store
     def make_prediction(self,x,y):
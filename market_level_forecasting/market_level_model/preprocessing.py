@@ -2,8 +2,16 @@ import numpy as np
 import pandas as pd
 
 class preprocessingMLS(object):
-    def __init__(self,dataPath):
-        self.df = pd.read_csv(dataPath)
+    mls_columns = ['property_id','list_date','sale_date','sale_price']
+
+    def __init__(self,dataPath,chunksize=None):
+        if chunksize is not None:
+            #streaming mode: the listing file is never held in memory as a whole
+            self.df = None
+            self._process_mls_chunks(dataPath, chunksize)
+            return
+        #dataPath is a csv path, or an already loaded listing table (e.g. data_store.read_table)
+        self.df = dataPath.copy() if isinstance(dataPath, pd.DataFrame) else pd.read_csv(dataPath)
         try:
             a = self.df['list_date']
             b = self.df['sale_date']
@@ -13,13 +21,90 @@ class preprocessingMLS(object):
 
     def _process_mls(self):
         listData = self.df
-        listData['sale_month'] = listData.sale_date.apply(lambda x: str(x)[:-3])
-        listData['list_month'] = listData.list_date.apply(lambda x: str(x)[:-3])
-        listMonth = listData.groupby(['list_month']).agg({"property_id":"count"}).reset_index()
-        saleMonth = listData.groupby(['sale_month']).agg({"property_id":"count","sale_price":"mean"}).reset_index() 
-        self.monthData = pd.merge(saleMonth,listMonth, left_on='sale_month',right_on='list_month')
-        self.monthData = self.monthData.rename(columns={"sale_month":"month","property_id_x":"count_sale", "property_id_y":"count_list"})
-        self.monthData = self.monthData.drop(['list_month'],axis=1)
+        listData['sale_month'] = self._to_month(listData.sale_date)
+        listData['list_month'] = self._to_month(listData.list_date)
+        self.month_totals = self._get_month_totals(listData)
+        self._set_monthly_data()
+
+    def _process_mls_chunks(self, dataPath, chunksize):
+        #read only the needed columns chunk by chunk, and fold each chunk into the month totals
+        month_totals = None
+        for chunk in pd.read_csv(dataPath, usecols=self.mls_columns, dtype={'list_date':str,'sale_date':str},
+                                 chunksize=chunksize):
+            chunk['sale_month'] = chunk['sale_date'].str[:-3]
+            chunk['list_month'] = chunk['list_date'].str[:-3]
+            chunk_totals = self._get_month_totals(chunk)
+            month_totals = chunk_totals if month_totals is None else self._add_month_totals(month_totals, chunk_totals)
+        self.month_totals = month_totals
+        self._set_monthly_data()
+
+    @staticmethod
+    def _to_month(dates):
+        #'YYYY-MM' of the csv date strings, or of the parsed dates of the parquet store
+        if pd.api.types.is_datetime64_any_dtype(dates):
+            return dates.dt.strftime('%Y-%m')
+        return dates.apply(lambda x: str(x)[:-3])
+
+    @staticmethod
+    def _add_month_totals(month_totals, new_totals):
+        month_totals = month_totals.reindex(month_totals.index.union(new_totals.index))
+        new_totals = new_totals.reindex(month_totals.index)
+        for col in ['count_sale','sale_price_sum','sale_price_count','count_list']:
+            month_totals[col] = month_totals[col].fillna(0) + new_totals[col].fillna(0)
+        for col in ['has_sale','has_list']:
+            month_totals[col] = month_totals[col].fillna(False).astype(bool) | new_totals[col].fillna(False).astype(bool)
+        return month_totals
+
+    @staticmethod
+    def _get_month_totals(listData):
+        #running per-month totals (counts and sale price sums) that new listings can be added to
+        listMonth = listData.groupby(['list_month']).agg(count_list=("property_id","count"))
+        saleMonth = listData.groupby(['sale_month']).agg(count_sale=("property_id","count"),
+                                                          sale_price_sum=("sale_price","sum"),
+                                                          sale_price_count=("sale_price","count"))
+        month_totals = saleMonth.join(listMonth, how='outer')
+        month_totals['has_sale'] = month_totals['count_sale'].notna()
+        month_totals['has_list'] = month_totals['count_list'].notna()
+        month_totals = month_totals.fillna(0)
+        month_totals.index.name = 'month'
+        return month_totals
+
+    def _set_monthly_data(self):
+        month_totals = self.month_totals[self.month_totals['has_sale'] & self.month_totals['has_list']].sort_index()
+        self.monthData = pd.DataFrame({'month':month_totals.index,
+                                       'count_sale':month_totals['count_sale'].values.astype(int),
+                                       'sale_price':(month_totals['sale_price_sum']/month_totals['sale_price_count'].replace(0, np.nan)).values,
+                                       'count_list':month_totals['count_list'].values.astype(int)})
+
+    @classmethod
+    def from_month_totals(cls, month_totals):
+        #rebuild from persisted month totals, without reading the listing file
+        process = cls.__new__(cls)
+        process.month_totals = month_totals
+        process._set_monthly_data()
+        return process
+
+    def update(self, new_listings, months=None):
+        """Add the listings of newly observed months to the monthly data.
+
+        Only the list / sale events that fall in months (default: the months after the
+        last month already counted) are added, so new_listings can hold older listings
+        that were sold in the new month. new_listings is a DataFrame or a csv path.
+        """
+        if isinstance(new_listings, str):
+            new_listings = pd.read_csv(new_listings, usecols=['property_id','list_date','sale_date','sale_price'])
+        new_listings = new_listings.copy()
+        new_listings['sale_month'] = self._to_month(new_listings.sale_date)
+        new_listings['list_month'] = self._to_month(new_listings.list_date)
+        if months is None:
+            last_month = self.monthData['month'].max()
+            months = sorted(set(new_listings['list_month']) | set(new_listings['sale_month']))
+            months = [month for month in months if month > last_month]
+        new_listings.loc[~new_listings['sale_month'].isin(months), 'sale_month'] = np.nan
+        new_listings.loc[~new_listings['list_month'].isin(months), 'list_month'] = np.nan
+        self.month_totals = self._add_month_totals(self.month_totals, self._get_month_totals(new_listings))
+        self._set_monthly_data()
+        return months
     
     def get_monthly_data(self,columns=['count_sale','count_list','sale_price'],start_date='2016-03', end_date='2020-09'):
         monthData = self.monthData
@@ -29,31 +114,128 @@ class preprocessingMLS(object):
 
 
 
+def _shifted(values, n):
+    #values shifted down by n rows, NaN in the first n rows
+    shifted = np.full(values.shape, np.nan)
+    shifted[n:] = values[:len(values)-n]
+    return shifted
+
+def lag_block(values, lag_num_list):
+    """n-row differences of each column of values (rows x columns), for each n of lag_num_list.
+    Columns ordered column by column then lag by lag, as create_lag_features"""
+    block = np.stack([values - _shifted(values, n) for n in lag_num_list], axis=2)
+    return block.reshape(len(values), -1)
+
+def pct_block(values, lag_num_list):
+    """n-row percent changes of each column of values + 100, forward filling missing values first
+    (pandas pct_change), for each n of lag_num_list"""
+    filled = pd.DataFrame(values).ffill().to_numpy() + 100
+    block = np.stack([filled / _shifted(filled, n) - 1 for n in lag_num_list], axis=2)
+    return block.reshape(len(values), -1)
+
+def month_one_hot(months):
+    """one hot of the month of year of 'YYYY-MM' months, columns '01m', '02m'... of the months present"""
+    t = pd.Series(months).str[-2:] + 'm'
+    columns = np.sort(t.unique())
+    return (t.to_numpy()[:, None] == columns[None, :]).astype(float), list(columns)
+
+def build_features(df, raw_feature_columns, spec=[('lag', [1,3]), ('pct', [1]), ('month_one_hot', None)], dtype=np.float32):
+    """Builds the feature matrix of featureEngineering from a spec, a list of steps applied in order:
+        ('lag', lag_num_list): create_lag_features, on all the features built so far
+        ('pct', lag_num_list): create_pct_change_features, on the raw features
+        ('month_one_hot', None): create_month_one_hot
+    Each step is computed on the whole matrix at once and the blocks are concatenated in one copy.
+    Returns the C-contiguous (rows x features) matrix of dtype and the feature names, in the order of
+    featureEngineering.get_feature_names()"""
+    raw = df[list(raw_feature_columns)].to_numpy(dtype=float)
+    blocks, names = [raw], list(raw_feature_columns)
+    for kind, lag_num_list in spec:
+        if kind == 'lag':
+            blocks.append(lag_block(np.hstack(blocks), lag_num_list))
+            names = names + [str(col)+'_lag'+str(n) for col in names for n in lag_num_list]
+        elif kind == 'pct':
+            blocks.append(pct_block(raw, lag_num_list))
+            names = names + [str(col)+'_pct'+str(n) for col in raw_feature_columns for n in lag_num_list]
+        elif kind == 'month_one_hot':
+            one_hot, columns = month_one_hot(df['month'])
+            blocks.append(one_hot)
+            names = names + columns
+        else:
+            raise ValueError('unknown feature kind: '+str(kind))
+    return np.ascontiguousarray(np.hstack(blocks), dtype=dtype), names
+
+
 class featureEngineering(object):
     def __init__(self,df,raw_feature_columns):
         self.df = df
         self.raw_feature_columns = raw_feature_columns
         self.feature_column_names = self.raw_feature_columns
+        self.derived_features = [] #(kind, column, n) in creation order, replayed by append_rows
+        self.one_hot_columns = None
+
+    def _add_columns(self, names, block):
+        #one concat instead of one insert per column
+        new_columns = pd.DataFrame(block, columns=names, index=self.df.index)
+        self.df = pd.concat([self.df.drop(columns=[col for col in names if col in self.df.columns]), new_columns], axis=1)
+        self.feature_column_names = np.append(self.feature_column_names, names)
 
     def create_lag_features(self,lag_num_list=[1,3]):
-        f = self.feature_column_names
-        for col in f:
-            for n in lag_num_list:
-                self.df[col+'_lag'+str(n)] = self.df[col].diff(n)
-                self.feature_column_names = np.append(self.feature_column_names,str(col)+'_lag'+str(n))
+        f = list(self.feature_column_names)
+        self._add_columns([str(col)+'_lag'+str(n) for col in f for n in lag_num_list],
+                          lag_block(self.df[f].to_numpy(dtype=float), lag_num_list))
+        self.derived_features += [('lag', col, n) for col in f for n in lag_num_list]
 
     def create_pct_change_features(self,lag_num_list=[1,]):
-        f = self.raw_feature_columns
-        for col in f:
-            for n in lag_num_list:
-                self.df[col+'_pct'+str(n)] = (self.df[col]+100).pct_change(periods = n)
-                self.feature_column_names = np.append(self.feature_column_names,str(col)+'_pct'+str(n))
+        f = list(self.raw_feature_columns)
+        self._add_columns([str(col)+'_pct'+str(n) for col in f for n in lag_num_list],
+                          pct_block(self.df[f].to_numpy(dtype=float), lag_num_list))
+        self.derived_features += [('pct', col, n) for col in f for n in lag_num_list]
 
     def create_month_one_hot(self,):
-        self.df['t'] = self.df['month'].apply(lambda x: str(x[-2:])+'m')
+        self.df['t'] = self.df['month'].str[-2:] + 'm'
         one_hot_month = pd.get_dummies(self.df['t'])
         self.feature_column_names = np.append(self.feature_column_names,one_hot_month.columns)
         self.df = self.df.join(one_hot_month)
+        self.one_hot_columns = one_hot_month.columns
+
+    def create_features(self, spec=[('lag', [1,3]), ('pct', [1]), ('month_one_hot', None)]):
+        """The create_* steps of spec (see build_features) at once"""
+        for kind, lag_num_list in spec:
+            if kind == 'lag':
+                self.create_lag_features(lag_num_list)
+            elif kind == 'pct':
+                self.create_pct_change_features(lag_num_list)
+            elif kind == 'month_one_hot':
+                self.create_month_one_hot()
+            else:
+                raise ValueError('unknown feature kind: '+str(kind))
+
+    def get_matrix(self, dtype=np.float32):
+        """The features as a C-contiguous (rows x features) matrix and their names"""
+        names = list(self.feature_column_names)
+        return np.ascontiguousarray(self.df[names].to_numpy(dtype=float), dtype=dtype), names
+
+    def append_rows(self, new_rows):
+        """Append newly observed months (rows with the month and raw feature columns) and
+        compute only their lag / pct change / one hot features, from the tail of the history."""
+        history = sum([n for kind, col, n in self.derived_features])
+        tail = self.df.iloc[len(self.df)-history:] if history > 0 else self.df.iloc[:0]
+        frame = pd.concat([tail, new_rows], ignore_index=True)
+        for kind, col, n in self.derived_features:
+            if kind == 'lag':
+                frame[col+'_lag'+str(n)] = lag_block(frame[[col]].to_numpy(dtype=float), [n])[:, 0]
+            else:
+                #forward filled over the whole history, as create_pct_change_features
+                values = pd.concat([self.df[col], new_rows[col]], ignore_index=True).to_numpy(dtype=float)[:, None]
+                frame[col+'_pct'+str(n)] = pct_block(values, [n])[len(values)-len(frame):, 0]
+        if self.one_hot_columns is not None:
+            frame['t'] = frame['month'].str[-2:] + 'm'
+            for col in self.one_hot_columns:
+                frame[col] = (frame['t'] == col).astype(self.df[col].dtype)
+        new_part = frame.iloc[len(tail):][self.df.columns]
+        new_part.index = pd.RangeIndex(len(self.df), len(self.df)+len(new_part))
+        self.df = pd.concat([self.df, new_part])
+        return self.df
 
     def get_dataFrame(self,):
         return self.df 